@@ -0,0 +1,46 @@
+/*
+ * fll-nosync, preloaded into the bootstrap utility and the chrooted
+ * commands of an fll build in unsafe-io mode. The chroot is compressed and
+ * thrown away, so there is no point waiting for its data to reach the disk:
+ * the calls which would wait return at once. Files opened with O_SYNC are
+ * still written synchronously.
+ *
+ * It is built without the C library, so that it can be preloaded into the
+ * commands of any chroot of the architecture it is built for.
+ *
+ * Author:    fll contributors
+ * Copyright: Copyright (C) 2026 fll contributors
+ * License:   GPL-2
+ */
+
+#include <stddef.h>
+
+int fsync(int fd)
+{
+	return 0;
+}
+
+int fdatasync(int fd)
+{
+	return 0;
+}
+
+int syncfs(int fd)
+{
+	return 0;
+}
+
+void sync(void)
+{
+}
+
+int msync(void *addr, size_t length, int flags)
+{
+	return 0;
+}
+
+int sync_file_range(int fd, long long offset, long long nbytes,
+		    unsigned int flags)
+{
+	return 0;
+}
@@ -7,6 +7,15 @@
 #
 archs		= list(default=list())
 
+# Number of architectures to build concurrently. Each architecture is built
+# in its own worker process and its output is logged to <dir>/<arch>.log,
+# which is printed when that build completes. A failed build does not abort
+# the builds of other architectures.
+#
+# Can be set via --jobs <JOBS> command line argument.
+#
+jobs		= integer(min=1, default=1)
+
 # The Debian mirror. config['apt']['sources']['debian']['uri'] and
 # config['chroot']['bootstrap']['uri'] default to this ($mirror). Either that
 # or comment this out and set those configuration items independently.
@@ -31,7 +40,10 @@ dir		= string(min=1, default='.')
 uid		= integer(default=0)
 gid		= integer(default=0)
 
-# Dry run mode. Do not perform time consuming processes.
+# Dry run mode. Plan the build of each architecture without building it:
+# print the packages which would be installed, the size of their download and
+# of their installation and the estimated size of each compressed image. The
+# image sizes use the ratios stored by fscomp tuning if there are any.
 #
 # Can be set via --dry-run command line argument.
 #
@@ -43,6 +55,15 @@ dryrun		= boolean(default=False)
 #
 verbosity	= option('quiet', 'verbose', 'debug', default='quiet')
 
+# Trace mode. Time each phase of the build and each command it executes.
+# The trace is written to <dir>/<arch>.trace.json, which can be loaded in
+# chrome://tracing or https://ui.perfetto.dev, and the phases and commands
+# which took the longest are summarised at the end of the build.
+#
+# Can be set via --trace command line argument.
+#
+trace		= boolean(default=False)
+
 __many__	= string(min=1)
 
 ##############################################################################
@@ -79,6 +100,39 @@ quiet		= boolean(default=False)
 verbose		= boolean(default=False)
 debug		= boolean(default=False)
 
+# Prefetch archives. When enabled, the packages of the build are resolved
+# with apt on the host and their archives are fetched into the package pool
+# while the chroot is bootstrapped and initialised, so that installing them
+# need not wait on the network. Requires a package pool.
+#
+# Can be set via --apt-prefetch command line argument.
+#
+prefetch	= boolean(default=False)
+
+
+# Package pool. When dir is set, the archives (.deb files) that apt fetches
+# are kept in dir, by sha256, and given to apt in later builds of any
+# architecture instead of fetching them again. The least recently used
+# archives are removed to keep the pool within size MB. The pool may be
+# shared by concurrent builds.
+#
+# Can be set via --apt-pool-dir <DIR> and --apt-pool-size <MB> command line
+# arguments.
+#
+[[pool]]
+dir		= string(default='')
+size		= integer(min=0, default=8192)
+
+# Package index cache. When dir is set, apt's package indexes are kept in
+# dir after each update and copied into the chroot before its first update,
+# so that apt only fetches indexes which have changed since a previous build
+# (or their pdiffs). Index files are named by apt after their URI, suite,
+# component and architecture.
+#
+# Can be set via --apt-lists-dir <DIR> command line argument.
+#
+[[lists]]
+dir		= string(default='')
 
 [[key]]
 # Toggle for trust verification of apt sources. By default apt will verify
@@ -167,6 +221,19 @@ dir		= string(default='')
 # Packages to be installed
 packages	= list(default=list())
 
+# Locales (eg. de_DE, pt_BR) to install the locale support packages of the
+# packages to be installed for, as mapped by data/locales-pkg-map.
+#
+# Can be set via --profile-locales <LOCALE>[ <LOCALE> ...]
+locales		= list(default=list())
+
+# Profile cache. When set, the packages of each profile and architecture are
+# kept in this directory, and are only parsed again from the package module
+# when a profile, list or directory of it changes.
+#
+# Can be set via --profile-cache <DIR>
+cache		= string(default='')
+
 
 ##############################################################################
 # General options for fll.chroot.Chroot class.
@@ -195,6 +262,30 @@ debug		= boolean(default=False)
 # Can be set via --hostname
 hostname       = string(min=1, default="chroot")
 
+# Execute chrooted commands via a helper process which chroots once, rather
+# than forking the build process and chrooting for each command.
+#
+# Can be set via --chroot-executor
+executor	= boolean(default=False)
+
+# Unsafe-io mode. The chroot is a throwaway, so skip the fsync()s which make
+# dpkg robust against power loss. dpkg is configured with force-unsafe-io,
+# and the bootstrap utility and chrooted commands preload fll-nosync, a shim
+# which makes fsync() and friends return at once. Both are removed when the
+# chroot is deinitialised. The shim is built with the host's C compiler, so
+# only for a chroot of the host's architecture, without it only dpkg skips
+# its fsync()s. An estimate of the time saved is printed and recorded in
+# the trace.
+#
+# Can be set via --chroot-unsafe-io
+unsafeio	= boolean(default=False)
+
+# Number of hooks to run concurrently, such as update-initramfs for each
+# kernel in the chroot.
+#
+# Can be set via --chroot-jobs
+jobs		= integer(min=1, default=1)
+
 # Bootstrap utility and options.
 #
 # For every keyword=value pair below exists a command line argument:
@@ -208,6 +299,46 @@ flavour		= option('minimal', 'build', 'standard', default='minimal')
 include		= string(default='apt-utils,bzip2,gnupg,systemd-sysv,xz-utils')
 exclude		= string(default='init,sysvinit,sysvinit-core')
 
+# Bootstrap cache. When dir is set, a snapshot of each bootstrapped chroot is
+# stored there and later builds with identical bootstrap options, architecture
+# and suite Release file restore the snapshot instead of bootstrapping. The
+# least recently used snapshots are removed to keep the cache within size MB.
+# The cache may be shared by concurrent builds.
+#
+# Can be set via --chroot-cache-dir <DIR> and --chroot-cache-size <MB> command
+# line arguments.
+#
+[[cache]]
+dir		= string(default='')
+size		= integer(min=0, default=4096)
+
+# Layered chroot. When dir is set, the chroot is an overlay of immutable
+# layers kept in dir, with the writes of the build going to an upper
+# directory. The bootstrap, init, common packages and profile packages build
+# stages each become a layer which other builds (of other profiles, say) reuse
+# when their inputs are identical, in place of running that stage. The
+# common packages stage installs packages, which should be the packages that
+# profiles have in common. The least recently used layers are removed to keep
+# the store within size MB. Requires overlayfs.
+#
+# Can be set via --chroot-layers-dir <DIR>, --chroot-layers-size <MB> and
+# --chroot-layers-packages <PACKAGES> command line arguments.
+#
+[[layers]]
+dir		= string(default='')
+size		= integer(min=0, default=16384)
+packages	= list(default=list())
+
+# Build the chroot in RAM. When size is set, a tmpfs of size MB is mounted at
+# the chroot if the host has that much memory available. If the packages to
+# be installed would not fit, the chroot is moved to a directory on disk
+# before installing them. Not used with a layered chroot.
+#
+# Can be set via --chroot-tmpfs-size <MB> command line argument.
+#
+[[tmpfs]]
+size		= integer(min=0, default=0)
+
 ##############################################################################
 # Each entry in this section is an environment variable keyword=value pair.
 #
@@ -239,10 +370,15 @@ __many__	= string(min=1)
 #
 [fscomp]
 
-# Type of compression to use for chroot filesystem "image". Not much choice
-# atm :) Each choice should have a subsection below.
+# List of types of compression to use for chroot filesystem "image": none,
+# mkfs, squashfs or tar. Not much choice atm :) Each choice should have a
+# subsection below. Several types are created concurrently.
 #
-compression	= option('none', 'mkfs', 'squashfs', 'tar', default='none')
+compression	= force_list(default=list('none'))
+
+# Number of cpus to share between the types of compression, 0 for all of
+# them. Unless set, a single type of compression is not limited.
+cpus		= integer(min=0, default=0)
 
 # Verbosity level of class. Inherits the top level 'verbosity' mode.
 #
@@ -253,7 +389,8 @@ quiet		= boolean(default=False)
 verbose		= boolean(default=False)
 debug		= boolean(default=False)
 
-# List of wrappers to apply to last output.  Only iso (or none) for now.
+# List of wrappers to apply to the output of the first type of compression.
+# Only iso (or none) for now.
 wrap		= list(default=list('none'))
 
 # Squashfs compression options.
@@ -261,8 +398,18 @@ wrap		= list(default=list('none'))
 [[squashfs]]
 # squashfs filename, can be set with --squashfs-file command line argument
 file            = string(min=0, default='')
-# gzip, lzo or xz compressor
-compressor	= option('gzip', 'lzo', 'xz', default='gzip')
+# gzip, lzo, lz4, xz or zstd compressor
+compressor	= option('gzip', 'lzo', 'lz4', 'xz', 'zstd', default='gzip')
+# compression level: 1-9 for gzip and lzo, 1-22 for zstd, any for lz4 high
+# compression mode. xz uses the BCJ filter of the architecture instead.
+# 0 selects the compressor default.
+level		= integer(min=0, max=22, default=0)
+# block size in bytes (4096 to 1048576, a power of 2), 0 for the default
+block		= integer(min=0, max=1048576, default=0)
+# number of processors mksquashfs may use, 0 for all of them
+processors	= integer(min=0, default=0)
+# memory limit of mksquashfs (eg. 512M, 2G), empty for the default
+mem		= string(default='')
 
 # Tar compression options.
 #
@@ -279,13 +426,58 @@ compressor	= option('gz', 'bz', 'xz', 'pz', default='gz')
 file            = string(min=0, default='')
 # just ext2, ext3, ext4 support (for now anyway)
 type           = option('ext2', 'ext3', 'ext4', default='ext2')
-# the size in MB to allocate (sparsely) for the initial filesystem
+# populate: create a filesystem sized to fit and populate it with mkfs -d
+# mount: copy the chroot into a loop mounted filesystem with rsync and
+# shrink it (needs root and the loop module)
+method          = option('populate', 'mount', default='populate')
+# the size in MB to allocate (sparsely) for the initial filesystem (mount)
 size            = integer(default='16000')
-# whether or not to resize and truncate the filesystem
+# whether or not to resize and truncate the filesystem (mount)
 shrink          = boolean(default=True)
-# what precentage of the apparent size to shrink to (rounded up to 1M)
+# what precentage of the apparent size to shrink to (rounded up to 1M), or
+# of the computed size and inodes (populate)
 factor          = integer(default=110)
 
+# deduplication options
+#
+[[dedup]]
+# hardlink identical regular files with the same ownership and mode and no
+# extended attributes before compressing the chroot. Linked files share
+# their content, so writing to one in a writable image writes to all.
+# Can be set with --dedup command line argument.
+enable		= boolean(default=False)
+# paths to deduplicate, wildcard patterns as for exclude
+include		= list(default=list('usr'))
+# size in bytes of the smallest file to deduplicate
+minsize		= integer(min=1, default=1)
+# number of files to hash at once, 0 for the number of cpus
+jobs		= integer(min=0, default=0)
+
+# compressor tuning options
+#
+[[tune]]
+# benchmark the candidate settings on a sample of the chroot before
+# compressing it, and use and store the one which best meets the goal.
+# Can be set with --tune command line argument.
+enable		= boolean(default=False)
+# file to store the chosen settings in, later builds use them unless set
+# in the config file or on the command line. Defaults to <dir>/fscomp.tune
+file		= string(min=0, default='')
+# approximate size in MB of the sample of the chroot
+sample		= integer(min=1, default=256)
+# size: the smallest image which is compressed within limit minutes
+# speed: the fastest decompression of an image within limit MB
+goal		= option('size', 'speed', default='size')
+# 0 for no limit
+limit		= integer(min=0, default=0)
+# number of candidates to benchmark at once, 0 for the number of cpus
+jobs		= integer(min=0, default=0)
+# squashfs candidates: compressor[:level[:block]], block may have K or M
+# suffix and a level of 0 is the compressor default
+squashfs	= list(default=list('gzip', 'gzip:9', 'lzo', 'lz4', 'lz4:1', 'xz', 'xz:0:1M', 'zstd:3', 'zstd:15', 'zstd:19', 'zstd:19:1M'))
+# tar candidates: compressor
+tar		= list(default=list('gz', 'bz', 'xz'))
+
 # iso options
 #
 [[iso]]
@@ -14,10 +14,13 @@ import apt.cache
 import apt.package
 import apt_pkg
 import datetime
+import hashlib
 import os
 import shutil
 import subprocess
+import fll.cache
 import fll.misc
+import fll.trace
 
 
 class AptLibError(Exception):
@@ -47,8 +50,29 @@ class AptLib(object):
         self.cache = None
         self._progress = AptLibProgress(quiet=config['quiet'])
 
+        self.pool = None
+        if config['pool']['dir']:
+            try:
+                self.pool = fll.cache.Cache(dirname=config['pool']['dir'],
+                                            size=config['pool']['size'])
+            except fll.cache.CacheError, e:
+                raise AptLibError(e)
+
+        self.lists = None
+        if config['lists']['dir']:
+            try:
+                self.lists = fll.cache.Cache(dirname=config['lists']['dir'])
+            except fll.cache.CacheError, e:
+                raise AptLibError(e)
+        self._lists_seeded = False
+        self._keys_imported = False
+
         self.sources_list(final_uri=False, src=config['src'])
         self._init_cache()
+        # Import gpg keys before the first update, so that only sources
+        # authenticated by a keyring package need be updated again.
+        if not config['key']['disable']:
+            self._import_keys()
         self.update()
         self.key(disable=config['key']['disable'])
 
@@ -106,26 +130,33 @@ class AptLib(object):
 
         for name, source in self.config['sources'].iteritems():
             description = source.get('description')
-            if final_uri and source.get('final_uri'):
-                uri = source.get('final_uri')
-            else:
-                uri = source.get('uri')
-            suites = source.get('suites')
-            components = source.get('components')
-
             fname = '/etc/apt/sources.list.d/%s.list' % name
             write_sources_list_comment(sources_list, [description, fname],
                                        mode='a')
-            
-            for suite in suites:
-                line = '%s %s %s' % (uri, suite, ' '.join(components))
-                try:
-                    with open(self.chroot.chroot_path(fname), 'w') as fh:
-                        print >>fh, 'deb ' + line
-                        if src:
-                            print >>fh, 'deb-src ' + line
-                except IOError, e:
-                    raise AptLibError('failed to write %s: %s' % (fname, e))
+
+            try:
+                with open(self.chroot.chroot_path(fname), 'w') as fh:
+                    for line in self._sources_lines(source, final_uri, src):
+                        print >>fh, line
+            except IOError, e:
+                raise AptLibError('failed to write %s: %s' % (fname, e))
+
+    def _sources_lines(self, source, final_uri=False, src=False):
+        """Return the sources.list lines of an apt source."""
+        if final_uri and source.get('final_uri'):
+            uri = source.get('final_uri')
+        else:
+            uri = source.get('uri')
+        suites = source.get('suites')
+        components = source.get('components')
+
+        lines = list()
+        for suite in suites:
+            line = '%s %s %s' % (uri, suite, ' '.join(components))
+            lines.append('deb ' + line)
+            if src:
+                lines.append('deb-src ' + line)
+        return lines
 
     def _gpg(self, args):
         """Fetch gpg public keys and save to apt's trusted keyring."""
@@ -136,23 +167,49 @@ class AptLib(object):
         gpg.extend(args)
         self.chroot.cmd(gpg)
 
+    @fll.trace.traced('apt key')
     def key(self, disable=False):
         """Import and gpg keys, install any -keyring packages that are
-        required to authenticate apt sources. Update and refresh apt cache."""
+        required to authenticate apt sources. Update and refresh apt cache.
+        Keys imported before the last update and keyring packages only
+        change the verification of apt sources, so apt sources which have
+        no keyring package are not updated again."""
         if disable is True:
             return
 
-        gpgkeys = []
         keyrings = []
+        keyring_sources = []
 
         for name, source in self.config['sources'].iteritems():
-            gpgkey = source.get('gpgkey')
-            if gpgkey:
-                gpgkeys.append(gpgkey)
-    
             keyring = source.get('keyring')
             if keyring:
                 keyrings.append(keyring)
+                keyring_sources.append(name)
+
+        if self._import_keys():
+            self.update()
+            keyring_sources = []
+
+        if keyrings:
+            self.install(keyrings)
+
+        if keyring_sources:
+            self.update(sources=keyring_sources)
+
+    def _import_keys(self):
+        """Import the gpg keys of apt sources into apt's trusted keyring.
+        Returns True if keys were imported, and False if there were none
+        or they had been imported before."""
+        if self._keys_imported:
+            return False
+        self._keys_imported = True
+
+        gpgkeys = []
+
+        for name, source in self.config['sources'].iteritems():
+            gpgkey = source.get('gpgkey')
+            if gpgkey:
+                gpgkeys.append(gpgkey)
 
         fetch_keys = []
         recv_keys = []
@@ -180,22 +237,31 @@ class AptLib(object):
             fetch_keys.insert(0, '--fetch-keys')
             self._gpg(fetch_keys)
 
-        if keyrings:
-            self.install(keyrings)
-
-        if keyrings or fetch_keys or recv_keys:
-            self.update()
+        return len(gpgkeys) > 0
 
     def commit(self):
-        print 'APT COMMIT INSTALL %d DELETE %d GET %sB REQ %sB' % \
+        self.chroot.require_space(max(0, self.cache.required_download +
+                                         self.cache.required_space))
+        seeded, missed, saved = self._pool_seed()
+
+        line = 'APT COMMIT INSTALL %d DELETE %d GET %sB REQ %sB' % \
             (self.cache.install_count,
              self.cache.delete_count,
              apt_pkg.size_to_str(self.cache.required_download),
              apt_pkg.size_to_str(self.cache.required_space))
+        if self.pool:
+            line += ' POOL HIT %d MISS %d SAVED %sB' % \
+                (seeded, len(missed), apt_pkg.size_to_str(saved))
+        print line
 
         mounted = self.chroot.mountvirtfs()
         try:
-            self.cache.commit(fetch_progress=self._progress)
+            # fetch before commit, so that the download and the unpacking
+            # and configuring of packages are traced apart
+            with fll.trace.span('apt download'):
+                self.cache.fetch_archives(progress=self._progress)
+            with fll.trace.span('apt dpkg'):
+                self.cache.commit(fetch_progress=self._progress)
         except apt.cache.FetchFailedException, e:
             raise AptLibError('apt failed to fetch required archives')
         except SystemError, e:
@@ -204,38 +270,303 @@ class AptLib(object):
             if mounted > 0:
                 self.chroot.umountvirtfs()
 
+        self._pool_store(missed)
         self.open()
 
-    def update(self):
-        print 'APT UPDATE'
+    def _archives(self, exclude=()):
+        """Yield (sha256, size, filename, uri) of each archive to be
+        installed by commit(), except those of the packages named in
+        exclude. filename is where apt expects to find the archive."""
+        def quote(string):
+            # apt's QuoteString(string, "_:")
+            quoted = ''
+            for c in string:
+                if c in '_:%' or not 0x20 < ord(c) < 0x7f:
+                    quoted += '%%%02x' % ord(c)
+                else:
+                    quoted += c
+            return quoted
+
+        archives = self.chroot.chroot_path('/var/cache/apt/archives')
+        for pkg in self.cache.get_changes():
+            if pkg.marked_delete or pkg.marked_keep or pkg.name in exclude:
+                continue
+            ver = pkg.candidate
+            if not ver or not ver.sha256:
+                continue
+            fname = '%s_%s_%s.deb' % (quote(pkg.shortname),
+                                      quote(ver.version),
+                                      quote(ver.architecture))
+            yield ver.sha256, ver.size, os.path.join(archives, fname), ver.uri
+
+    def _pool_seed(self):
+        """Put archives found in the package pool where apt will find them,
+        so that apt does not fetch them. Returns number of archives seeded,
+        list of (sha256, filename) of archives not found and number of bytes
+        not fetched."""
+        seeded = saved = 0
+        missed = list()
+
+        if self.pool is None:
+            return seeded, missed, saved
+
+        for sha256, size, fname, uri in self._archives():
+            if os.path.exists(fname):
+                continue
+            pin = self.pool.pin(sha256)
+            try:
+                entry = self.pool.lookup(sha256)
+                if entry is None:
+                    missed.append((sha256, fname))
+                    continue
+                try:
+                    os.link(entry, fname)
+                except OSError:
+                    shutil.copy2(entry, fname)
+                seeded += 1
+                saved += size
+            finally:
+                self.pool.unpin(pin)
+
+        return seeded, missed, saved
+
+    def _pool_store(self, missed):
+        """Add archives fetched by apt to the package pool."""
+        if self.pool is None:
+            return
+
+        for sha256, fname in missed:
+            if not os.path.isfile(fname):
+                continue
+            h = hashlib.sha256()
+            with open(fname, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(2**20), ''):
+                    h.update(chunk)
+            if h.hexdigest() != sha256:
+                continue
+            try:
+                self.pool.store(sha256, fname, evict=False)
+            except fll.cache.CacheError, e:
+                print 'APT POOL %s' % e
+        self.pool.evict()
+
+    def prefetch(self, exclude=()):
+        """Fetch the archives of the packages marked for installation into
+        the package pool without installing them, so that a later commit()
+        of the same packages, by this or another build, finds them there.
+        Archives of the packages named in exclude or already in the pool
+        are not fetched. Archives which fail to fetch are left for commit()
+        to fetch."""
+        if self.pool is None:
+            raise AptLibError('prefetch requires a package pool')
+
+        fetcher = apt_pkg.Acquire(self._progress)
+        items = list()
+        missed = list()
+        size = 0
+        for sha256, nbytes, fname, uri in self._archives(exclude):
+            if self.pool.lookup(sha256) is not None:
+                continue
+            items.append(apt_pkg.AcquireFile(fetcher, uri=uri,
+                hash='SHA256:%s' % sha256, size=nbytes, descr=uri,
+                short_descr=os.path.basename(fname), destfile=fname))
+            missed.append((sha256, fname))
+            size += nbytes
+
+        print 'APT PREFETCH GET %d %sB' % (len(items),
+                                           apt_pkg.size_to_str(size))
+        if items:
+            with fll.trace.span('apt download'):
+                fetcher.run()
+        self._pool_store(missed)
+
+    @fll.trace.traced('apt update')
+    def update(self, sources=None):
+        """Update apt's package indexes. sources is a list of names of apt
+        sources to update, all are updated by default."""
+        line = 'APT UPDATE'
+        if sources:
+            line += ' ' + ' '.join(sources)
+        print line
+        self._lists_seed()
+
+        sources_list = None
+        if sources:
+            sources_list = NamedTemporaryFile(
+                dir=self.chroot.chroot_path('/etc/apt'), prefix='sources_')
+            for name in sources:
+                source = self.config['sources'][name]
+                for line in self._sources_lines(source,
+                                                src=self.config['src']):
+                    print >>sources_list, line
+            sources_list.flush()
+
         try:
-            self.cache.update(fetch_progress=self._progress)
+            if sources_list:
+                self.cache.update(fetch_progress=self._progress,
+                                  sources_list=sources_list.name)
+            else:
+                self.cache.update(fetch_progress=self._progress)
         except apt.cache.FetchFailedException, e:
             raise AptLibError('apt failed to fetch required archives')
+        finally:
+            if sources_list:
+                sources_list.close()
+
+        self._lists_store()
         self.open()
 
+    def _lists_files(self, files):
+        """Filter the names of files in apt's lists directory, returning
+        those which belong to the suites, components and architecture of
+        the configured apt sources."""
+        releases = ('InRelease', 'Release', 'Release.gpg')
+        prefixes = list()
+        for name, source in self.config['sources'].iteritems():
+            for suite in source.get('suites'):
+                prefix = apt_pkg.uri_to_filename('%s/dists/%s/' %
+                    (source.get('uri').rstrip('/'), suite))
+                components = [apt_pkg.uri_to_filename(c) + '_'
+                              for c in source.get('components')]
+                prefixes.append((prefix, components))
+
+        binary = '_binary-%s_' % self.chroot.architecture
+        for fname in files:
+            if '_binary-' in fname and binary not in fname:
+                continue
+            for prefix, components in prefixes:
+                if not fname.startswith(prefix):
+                    continue
+                rest = fname[len(prefix):]
+                if rest in releases or \
+                   [c for c in components if rest.startswith(c)]:
+                    yield fname
+                    break
+
+    def _lists_seed(self):
+        """Copy cached package indexes into apt's lists directory before
+        the first update, so apt need only check they are current."""
+        if self.lists is None or self._lists_seeded:
+            return
+        self._lists_seeded = True
+
+        lists = self.chroot.chroot_path('/var/lib/apt/lists')
+        if not os.path.isdir(lists):
+            os.makedirs(lists)
+
+        with self.lists.lock(shared=True):
+            cached = [f for f in os.listdir(self.lists.dirname)
+                      if not f.endswith(('.size', '.pin'))]
+            for fname in self._lists_files(cached):
+                if os.path.exists(os.path.join(lists, fname)):
+                    continue
+                shutil.copy2(self.lists.path(fname),
+                             os.path.join(lists, fname))
+
+    def _lists_store(self):
+        """Copy apt's package indexes into the cache of package indexes,
+        unless the cache is read only, as when the indexes were not
+        verified."""
+        if self.lists is None or self.config['lists'].get('readonly'):
+            return
+
+        lists = self.chroot.chroot_path('/var/lib/apt/lists')
+        for fname in self._lists_files(os.listdir(lists)):
+            try:
+                self.lists.store(fname, os.path.join(lists, fname),
+                                 replace=True)
+            except fll.cache.CacheError, e:
+                print 'APT LISTS %s' % e
+
+    def index_key(self):
+        """Return a digest of the Release files of apt's sources, which
+        identifies the state of apt's package indexes."""
+        lists = self.chroot.chroot_path('/var/lib/apt/lists')
+        h = hashlib.sha256()
+        for fname in sorted(os.listdir(lists)):
+            if not fname.endswith('Release'):
+                continue
+            with open(os.path.join(lists, fname)) as fh:
+                h.update(fname + '\0' + fh.read())
+        return h.hexdigest()
+
+    def conf_key(self):
+        """Return a digest of the user configurable preferences of apt,
+        which change the packages install() resolves to."""
+        return fll.cache.digest(sorted(['%s=%s' % (k, v) for k, v in
+                                        self.config['conf'].iteritems()]))
+
+    @fll.trace.traced('apt cache')
     def open(self):
         print 'APT CACHE'
         self.cache.open()
 
     def dist_upgrade(self, commit=True):
-        self.cache.upgrade(dist_upgrade=True)
+        with fll.trace.span('apt mark'):
+            self.cache.upgrade(dist_upgrade=True)
 
         if commit:
             self.commit()
 
-    def install(self, packages, commit=True):
-        #with self.cache.actiongroup(): # segfaults
+    def _packages(self, packages):
+        """Return the packages of the cache by name, or raise AptLibError
+        naming all those which are not in it."""
+        pkgs = list()
+        unknown = list()
         for p in packages:
-            self.cache[p].mark_install()
+            try:
+                pkgs.append(self.cache[p])
+            except KeyError:
+                unknown.append(p)
+        if unknown:
+            raise AptLibError('unknown packages: %s' %
+                              ' '.join(sorted(unknown)))
+        return pkgs
+
+    def _resolve(self, pkgs):
+        """Resolve the broken dependencies left by marking pkgs, once for
+        all of them, without changing the marks of pkgs themselves."""
+        if self.cache.broken_count == 0:
+            return
+        fix = apt.cache.ProblemResolver(self.cache)
+        for pkg in pkgs:
+            fix.clear(pkg)
+            fix.protect(pkg)
+        try:
+            fix.resolve()
+        except SystemError, e:
+            broken = [pkg.name for pkg in pkgs if pkg.is_inst_broken]
+            raise AptLibError('unresolvable packages: %s (%s)' %
+                              (' '.join(sorted(broken)) or '-', e))
+
+    def install(self, packages, commit=True):
+        """Mark packages for installation. All are marked within one
+        action group, first without their dependencies so that none of
+        them is marked as automatically installed, then with them. Within
+        the action group apt does not sweep the automatically installed
+        packages after each mark, which is most of the cost of marking
+        package by package. The problem resolver is run once, after the
+        action group is released, rather than for each package."""
+        pkgs = self._packages(packages)
+        with fll.trace.span('apt mark', count=len(pkgs)):
+            with self.cache.actiongroup():
+                for pkg in pkgs:
+                    pkg.mark_install(auto_fix=False, auto_inst=False)
+                for pkg in pkgs:
+                    pkg.mark_install(auto_fix=False)
+            self._resolve(pkgs)
 
         if commit:
             self.commit()
 
     def purge(self, packages, commit=True):
-        #with self.cache.actiongroup(): # segfaults
-        for p in packages:
-            self.cache[p].mark_delete(purge=True)
+        pkgs = self._packages(packages)
+        with fll.trace.span('apt mark', count=len(pkgs)):
+            with self.cache.actiongroup():
+                for pkg in pkgs:
+                    pkg.mark_delete(auto_fix=False, purge=True)
+            self._resolve(pkgs)
+
         if commit:
             self.commit()
 
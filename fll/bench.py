@@ -0,0 +1,672 @@
+"""
+This is the fll.bench module, it provides a synthetic apt repository of
+dummy packages and a benchmark which builds a chroot from it end to end,
+without network access, so that the performance of fll can be measured and
+compared between changes.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+from configobj import ConfigObj
+from StringIO import StringIO
+from validate import Validator
+
+import SimpleHTTPServer
+import SocketServer
+import email.utils
+import glob
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import tarfile
+import threading
+import time
+import urllib
+
+from fll.chroot import Chroot
+
+import fll.build
+import fll.cache
+import fll.config
+import fll.misc
+import fll.trace
+
+
+class BenchError(Exception):
+    """
+    An Error class for use by Repo, Base and Bench.
+    """
+    pass
+
+
+class Repo(object):
+    """
+    A class which generates a signed apt repository of dummy packages. The
+    packages depend on each other as a library stack does, a package
+    depending on a few others and more often on the lower ones. Their
+    files are of log-normally distributed size, half of them compressible
+    text and half random data. Every tenth package has a l10n package for
+    each locale, for FllLocales to detect. The repository is generated
+    once for a set of options and is then reused.
+
+    Options        Type   Description
+    --------------------------------------------------------------------------
+    dirname      - (str)  path to repository
+    architecture - (str)  architecture of the package index
+    packages     - (int)  number of packages
+    files        - (int)  mean number of files of a package
+    size         - (int)  mean size of a file in kB
+    depends      - (int)  mean number of dependencies of a package
+    locales      - (list) locales to create l10n packages for
+    seed         - (int)  seed of the random generator
+    """
+    suite = 'bench'
+    component = 'main'
+    mtime = 1262304000
+    poolsize = 2**22
+
+    def __init__(self, dirname=None, architecture=None, packages=500,
+                 files=20, size=32, depends=3, locales=['de_DE', 'pt_BR'],
+                 seed=0):
+        if not dirname:
+            raise BenchError('must specify dirname=')
+        if not architecture:
+            raise BenchError('must specify architecture=')
+
+        self.dirname = os.path.realpath(dirname)
+        self.architecture = architecture
+        self.params = dict(packages=packages, files=files, size=size,
+                           depends=depends, locales=sorted(locales),
+                           seed=seed, architecture=architecture)
+        self.locales = locales
+        self.keyring = os.path.join(self.dirname, 'bench.gpg')
+        self.gnupg = os.path.join(self.dirname, 'gnupg')
+
+    def names(self):
+        """Return the names of the packages, less the l10n packages."""
+        return ['bench-%04d' % i for i in range(self.params['packages'])]
+
+    def roots(self):
+        """Return the names of the packages which no others depend on
+        most often, to be installed by a profile."""
+        names = self.names()
+        return names[-max(1, len(names) / 10):]
+
+    def localesmap(self):
+        """Return the map of FllLocales, of packages to the prefixes of
+        their l10n packages."""
+        return dict([(name, [name + '-l10n'])
+                     for name in self.names()[::10]])
+
+    def l10n(self, name):
+        """Return the names of the l10n packages of a package."""
+        if name not in self.localesmap():
+            return []
+        names = list()
+        for locale in self.locales:
+            ll, cc = locale.lower().split('_')
+            names.append('%s-l10n-%s' % (name, ll == cc and ll or
+                                                '%s-%s' % (ll, cc)))
+        return names
+
+    def uri(self, scheme='file'):
+        """Return the uri of the repository. apt does not copy the packages
+        of a file uri into the chroot, dpkg in the chroot cannot reach them
+        there, so apt is given a copy uri."""
+        return '%s://%s' % (scheme, urllib.pathname2url(self.dirname))
+
+    def generate(self):
+        """Generate the repository, unless it was for the same options."""
+        paramsfile = os.path.join(self.dirname, 'bench.params')
+        if os.path.isfile(paramsfile):
+            with open(paramsfile) as fh:
+                if json.load(fh) == self.params:
+                    return
+            shutil.rmtree(self.dirname)
+        os.makedirs(self.dirname)
+
+        rng = random.Random(self.params['seed'])
+        self._pools(rng)
+        self._key()
+
+        stanzas = list()
+        names = self.names()
+        for i, name in enumerate(names):
+            depends = set()
+            for n in range(self._count(rng, self.params['depends'], i)):
+                depends.add(names[int(i * rng.random() ** 2)])
+            stanzas.append(self._package(rng, name, sorted(depends)))
+            for l10n in self.l10n(name):
+                stanzas.append(self._package(rng, l10n, [name], files=2))
+
+        self._index(stanzas)
+
+        with open(paramsfile, 'w') as fh:
+            json.dump(self.params, fh)
+
+    def _count(self, rng, mean, limit=None):
+        """Return a random count, distributed about mean."""
+        count = int(round(rng.expovariate(1.0 / mean))) if mean else 0
+        if limit is not None:
+            count = min(count, limit)
+        return count
+
+    def _pools(self, rng):
+        """Create the pools of text and random data files are cut from."""
+        words = ['%x' % rng.getrandbits(rng.randint(8, 40))
+                 for i in range(2048)]
+        text = list()
+        length = 0
+        while length < self.poolsize:
+            line = ' '.join(rng.sample(words, rng.randint(4, 12))) + '\n'
+            text.append(line)
+            length += len(line)
+        self.text = ''.join(text)[:self.poolsize]
+        start = rng.randint(0, 2**20)
+        self.data = ''.join([hashlib.sha256('%d' % i).digest()
+                             for i in range(start,
+                                            start + self.poolsize / 32)])
+
+    def _content(self, rng, size):
+        pool = rng.random() < 0.5 and self.text or self.data
+        offset = rng.randint(0, len(pool) - 1)
+        content = pool[offset:offset + size]
+        while len(content) < size:
+            content += pool[:size - len(content)]
+        return content
+
+    def _key(self):
+        """Generate the key which signs the repository."""
+        os.mkdir(self.gnupg, 0700)
+        gpg = ['gpg', '--homedir', self.gnupg, '--batch', '--quiet']
+        fll.misc.cmd(gpg + ['--passphrase', '', '--quick-gen-key',
+                            'fll bench <bench@localhost>', 'rsa2048', 'sign',
+                            'never'], silent=True)
+        with open(self.keyring, 'w') as fh:
+            fh.write(fll.misc.cmd(gpg + ['--export'], pipe=True,
+                                  silent=True))
+
+    def _package(self, rng, name, depends, files=None):
+        """Write the .deb of a package and return its index stanza."""
+        if files is None:
+            files = max(1, self._count(rng, self.params['files']))
+        mean = math.log(self.params['size'] * 1024)
+
+        contents = [('usr/share/doc/%s/copyright' % name,
+                     self._content(rng, 1024), 0644)]
+        if rng.random() < 0.2:
+            contents.append(('usr/bin/%s' % name,
+                             '#!/bin/sh\necho %s\n' % name, 0755))
+        for n in range(files):
+            size = min(int(rng.lognormvariate(mean, 1.0)), 2**24)
+            subdir = rng.choice(['share', 'lib'])
+            contents.append(('usr/%s/bench/%s/f%03d' % (subdir, name, n),
+                             self._content(rng, size), 0644))
+        contents.sort()
+
+        control = ['Package: %s' % name,
+                   'Version: 1.0-1',
+                   'Architecture: all',
+                   'Maintainer: fll bench <bench@localhost>',
+                   'Installed-Size: %d' % sum([len(c) / 1024 + 1
+                                               for p, c, m in contents]),
+                   'Section: misc',
+                   'Priority: optional']
+        if depends:
+            control.append('Depends: %s' % ', '.join(depends))
+        control.append('Description: synthetic package %s' % name)
+        control.append(' A dummy package of the fll benchmark.')
+
+        scripts = list()
+        if rng.random() < 0.1:
+            scripts.append(('postinst', '#!/bin/sh\nset -e\nexit 0\n'))
+
+        pool = 'pool/%s/%s/%s' % (self.component, name[0], name)
+        if not os.path.isdir(os.path.join(self.dirname, pool)):
+            os.makedirs(os.path.join(self.dirname, pool))
+        filename = '%s/%s_1.0-1_all.deb' % (pool, name)
+        size, sha256, md5 = self._deb(os.path.join(self.dirname, filename),
+                                      control, contents, scripts)
+        return control[:-2] + ['Filename: %s' % filename,
+                               'Size: %d' % size,
+                               'MD5sum: %s' % md5,
+                               'SHA256: %s' % sha256] + control[-2:]
+
+    def _tar(self, members):
+        """Return a tar.gz of (path, content, mode) members, and their
+        parent directories."""
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        dirs = set()
+        for path, content, mode in members:
+            parts = path.split('/')[:-1]
+            for n in range(1, len(parts) + 1):
+                d = '/'.join(parts[:n])
+                if d in dirs:
+                    continue
+                dirs.add(d)
+                info = tarfile.TarInfo('./' + d)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0755
+                info.mtime = self.mtime
+                info.uname = info.gname = 'root'
+                tar.addfile(info)
+            info = tarfile.TarInfo('./' + path)
+            info.size = len(content)
+            info.mode = mode
+            info.mtime = self.mtime
+            info.uname = info.gname = 'root'
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        return buf.getvalue()
+
+    def _deb(self, filename, control, contents, scripts):
+        """Write a .deb, an ar archive of its version, control.tar.gz and
+        data.tar.gz. Returns its size, sha256 and md5."""
+        md5sums = ''.join(['%s  %s\n' % (hashlib.md5(c).hexdigest(), p)
+                           for p, c, m in contents])
+        members = [('control', '\n'.join(control) + '\n', 0644),
+                   ('md5sums', md5sums, 0644)]
+        members.extend([(s, c, 0755) for s, c in scripts])
+
+        deb = StringIO()
+        deb.write('!<arch>\n')
+        for name, data in [('debian-binary', '2.0\n'),
+                           ('control.tar.gz', self._tar(members)),
+                           ('data.tar.gz', self._tar(contents))]:
+            deb.write('%-16s%-12d%-6d%-6d%-8o%-10d`\n' %
+                      (name, self.mtime, 0, 0, 0100644, len(data)))
+            deb.write(data)
+            if len(data) % 2:
+                deb.write('\n')
+        deb = deb.getvalue()
+
+        with open(filename, 'w') as fh:
+            fh.write(deb)
+        return (len(deb), hashlib.sha256(deb).hexdigest(),
+                hashlib.md5(deb).hexdigest())
+
+    def _index(self, stanzas):
+        """Write the package index and the signed Release file."""
+        dists = os.path.join(self.dirname, 'dists', self.suite)
+        binary = '%s/binary-%s' % (self.component, self.architecture)
+        os.makedirs(os.path.join(dists, binary))
+
+        packages = '\n'.join(['\n'.join(s) + '\n' for s in stanzas])
+        indexes = list()
+        with open(os.path.join(dists, binary, 'Packages'), 'w') as fh:
+            fh.write(packages)
+        indexes.append((binary + '/Packages', packages))
+        buf = StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='w', mtime=self.mtime)
+        gz.write(packages)
+        gz.close()
+        with open(os.path.join(dists, binary, 'Packages.gz'), 'w') as fh:
+            fh.write(buf.getvalue())
+        indexes.append((binary + '/Packages.gz', buf.getvalue()))
+
+        release = ['Origin: fll-bench',
+                   'Label: fll-bench',
+                   'Suite: %s' % self.suite,
+                   'Codename: %s' % self.suite,
+                   'Date: %s' % email.utils.formatdate(usegmt=True),
+                   'Architectures: %s all' % self.architecture,
+                   'Components: %s' % self.component,
+                   'Description: fll benchmark repository']
+        for field, algorithm in [('MD5Sum', hashlib.md5),
+                                 ('SHA256', hashlib.sha256)]:
+            release.append('%s:' % field)
+            for path, content in indexes:
+                release.append(' %s %16d %s' % (
+                    algorithm(content).hexdigest(), len(content), path))
+        with open(os.path.join(dists, 'Release'), 'w') as fh:
+            fh.write('\n'.join(release) + '\n')
+
+        gpg = ['gpg', '--homedir', self.gnupg, '--batch', '--quiet', '--yes',
+               '--digest-algo', 'SHA256']
+        fll.misc.cmd(gpg + ['--clearsign', '-o',
+                            os.path.join(dists, 'InRelease'),
+                            os.path.join(dists, 'Release')], silent=True)
+        fll.misc.cmd(gpg + ['--armor', '--detach-sign', '-o',
+                            os.path.join(dists, 'Release.gpg'),
+                            os.path.join(dists, 'Release')], silent=True)
+
+
+class Base(object):
+    """
+    A class which assembles a minimal chroot from the packages installed on
+    the host: the essential packages, the packages given and their
+    dependencies. Its tar archive stands in for a bootstrap snapshot, so
+    that a chroot can be built without a Debian mirror.
+
+    Options   Type   Description
+    --------------------------------------------------------------------------
+    packages - (list) packages to include besides the essential packages
+    keyring  - (str)  path to a keyring for apt to trust
+    """
+    dirs = ['dev/pts', 'proc', 'sys', 'run', 'root', 'etc/apt/apt.conf.d',
+            'etc/apt/preferences.d', 'etc/apt/sources.list.d',
+            'etc/apt/trusted.gpg.d', 'var/lib/apt/lists/partial',
+            'var/cache/apt/archives/partial', 'var/lib/dpkg/updates',
+            'var/cache/debconf', 'var/log', 'etc/network']
+    files = ['etc/passwd', 'etc/group', 'etc/shadow', 'etc/gshadow',
+             'dev/null', 'dev/zero', 'dev/full', 'dev/random', 'dev/urandom',
+             'dev/tty', 'var/lib/dpkg/diversions',
+             'var/lib/dpkg/statoverride', 'var/cache/debconf/config.dat',
+             'var/cache/debconf/templates.dat']
+    trees = ['etc/alternatives', 'var/lib/dpkg/alternatives']
+
+    def __init__(self, packages=[], keyring=None):
+        self.packages = packages
+        self.keyring = keyring
+
+    def installed(self):
+        """Return a dict of the installed packages of the host, by name, of
+        (qualified name, essential, dependencies), and a dict of the
+        packages which provide each virtual package."""
+        fmt = '${binary:Package}\t${db:Status-Abbrev}\t${Essential}\t' \
+              '${Provides}\t${Pre-Depends}, ${Depends}\n'
+        output = fll.misc.cmd(['dpkg-query', '-W', '-f', fmt], pipe=True,
+                              silent=True)
+        packages = dict()
+        provides = dict()
+        for line in output.splitlines():
+            qualified, status, essential, provided, depends = \
+                line.split('\t')
+            if not status.startswith('ii'):
+                continue
+            name = qualified.split(':')[0]
+            if name in packages:
+                continue
+            alternatives = list()
+            for dep in depends.split(','):
+                alts = [a.split()[0].split(':')[0] for a in dep.split('|')
+                        if a.strip()]
+                if alts:
+                    alternatives.append(alts)
+            packages[name] = (qualified, essential == 'yes', alternatives)
+            for p in provided.split(','):
+                if p.strip():
+                    provides.setdefault(p.split()[0], list()).append(name)
+        return packages, provides
+
+    def closure(self):
+        """Return the qualified names of the packages of the base."""
+        packages, provides = self.installed()
+        for name in self.packages:
+            if name not in packages:
+                raise BenchError('package not installed on host: %s' % name)
+
+        todo = [n for n, p in packages.iteritems() if p[1]]
+        todo.extend(self.packages)
+        todo.extend(['apt', 'debconf'])
+        base = set()
+        while todo:
+            name = todo.pop()
+            if name in base or name not in packages:
+                continue
+            base.add(name)
+            for alts in packages[name][2]:
+                for alt in alts:
+                    found = [a for a in [alt] + provides.get(alt, [])
+                             if a in packages]
+                    if found:
+                        todo.append(found[0])
+                        break
+        return sorted([packages[n][0] for n in base])
+
+    def write(self, filename):
+        """Write the tar archive of the base."""
+        packages = self.closure()
+        output = fll.misc.cmd(['dpkg-query', '-L'] + packages, pipe=True,
+                              silent=True)
+        # the symlinks of a merged /usr, and the paths of files beneath
+        # them by their real parent directory, so that none is archived
+        # twice
+        paths = set([p for p in os.listdir('/')
+                     if os.path.islink('/' + p) and
+                     os.readlink('/' + p).lstrip('/').startswith('usr/')])
+        for p in output.splitlines():
+            if not p.startswith('/') or p == '/.':
+                continue
+            parent, name = os.path.split(p)
+            paths.add(os.path.join(os.path.realpath(parent),
+                                   name).lstrip('/'))
+        status = fll.misc.cmd(['dpkg-query', '-s'] + packages, pipe=True,
+                              silent=True)
+        for qualified in packages:
+            name = qualified.split(':')[0]
+            for info in glob.glob('/var/lib/dpkg/info/%s.*' % name) + \
+                        glob.glob('/var/lib/dpkg/info/%s:*.*' % name):
+                paths.add(info.lstrip('/'))
+        paths.update(self.files)
+        for tree in self.trees:
+            for f in glob.glob('/%s/*' % tree):
+                paths.add(f.lstrip('/'))
+
+        tar = tarfile.open(filename, 'w')
+        try:
+            # the top level symlinks first, to extract beneath them
+            for p in sorted(paths, key=lambda p: (p.count('/'), p)):
+                if os.path.lexists('/' + p) and \
+                   not (os.path.isdir('/' + p) and
+                        not os.path.islink('/' + p)):
+                    tar.add('/' + p, arcname=p, recursive=False)
+                elif os.path.isdir('/' + p):
+                    self._dir(tar, p, os.lstat('/' + p).st_mode & 07777)
+            for d in self.dirs:
+                self._dir(tar, d, 0755)
+            self._dir(tar, 'tmp', 01777)
+            self._dir(tar, 'var/tmp', 01777)
+            self._file(tar, 'var/lib/dpkg/status', status)
+            self._file(tar, 'var/lib/dpkg/available', '')
+            if self.keyring:
+                with open(self.keyring) as fh:
+                    self._file(tar, 'etc/apt/trusted.gpg.d/fll-bench.gpg',
+                               fh.read())
+        finally:
+            tar.close()
+
+    def _dir(self, tar, path, mode):
+        info = tarfile.TarInfo(path)
+        info.type = tarfile.DIRTYPE
+        info.mode = mode
+        info.mtime = time.time()
+        tar.addfile(info)
+
+    def _file(self, tar, path, content):
+        info = tarfile.TarInfo(path)
+        info.size = len(content)
+        info.mode = 0644
+        info.mtime = time.time()
+        tar.addfile(info, StringIO(content))
+
+
+class _RepoHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve the files of the repository of the server, quietly."""
+    def translate_path(self, path):
+        path = urllib.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        parts = [p for p in path.split('/') if p not in ('', '.', '..')]
+        return os.path.join(self.server.root, *parts)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _RepoServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Bench(object):
+    """
+    A class which benchmarks a build: a chroot is bootstrapped from a base
+    assembled from the host, packages of a profile and their l10n packages
+    are installed from a synthetic repository, and the chroot is
+    compressed. Each phase and command is traced, and the wall time of each
+    phase of each run is returned.
+
+    Options       Type                Description
+    --------------------------------------------------------------------------
+    dirname     - (str)               path to benchmark directory
+    repo        - (fll.bench.Repo)    fll.bench.Repo object
+    compression - (list)              types of compression
+    http        - (bool)              serve the repository over http on
+                                      localhost rather than file://
+    options     - (dict)              configuration items to set, by
+                                      section path (eg. 'chroot/executor')
+    """
+    depends = dict(squashfs=['squashfs-tools'], mkfs=['e2fsprogs'])
+
+    def __init__(self, dirname=None, repo=None, compression=['tar'],
+                 http=False, options={}):
+        if not dirname:
+            raise BenchError('must specify dirname=')
+        if repo is None:
+            raise BenchError('must specify repo=')
+
+        self.dirname = os.path.realpath(dirname)
+        self.repo = repo
+        self.compression = compression
+        self.http = http
+        self.options = options
+        self.arch = repo.architecture
+        self.server = None
+
+    def config(self, uri):
+        """Return a validated configuration of the build, with the defaults
+        of the configuration spec."""
+        config = ConfigObj(configspec=fll.config.get_config_spec(),
+                           interpolation='template')
+        config.validate(Validator(), copy=True)
+
+        config['mirror'] = uri
+        config['dir'] = self.dirname
+        config['archs'] = [self.arch]
+        for section in ('apt', 'chroot', 'fscomp'):
+            config[section]['quiet'] = True
+
+        if uri.startswith('file:'):
+            config['apt']['sources']['debian']['uri'] = self.repo.uri('copy')
+        config['apt']['sources']['debian']['suites'] = [self.repo.suite]
+        config['apt']['sources']['debian']['components'] = \
+            [self.repo.component]
+        config['apt']['key']['disable'] = True
+
+        config['chroot']['bootstrap']['suite'] = self.repo.suite
+        config['chroot']['cache']['dir'] = os.path.join(self.dirname,
+                                                        'cache')
+
+        config['profile']['name'] = 'bench'
+        config['profile']['dir'] = os.path.join(self.dirname, 'profiles')
+        config['profile']['locales'] = self.repo.locales
+
+        out = os.path.join(self.dirname, 'out')
+        config['fscomp']['compression'] = self.compression
+        config['fscomp']['squashfs']['file'] = os.path.join(out, 'rootfs.sq')
+        config['fscomp']['tar']['file'] = os.path.join(out, 'rootfs.tar')
+        config['fscomp']['mkfs']['file'] = os.path.join(out, 'rootfs.img')
+
+        for path, value in self.options.iteritems():
+            keys = path.split('/')
+            section = config
+            for key in keys[:-1]:
+                section = section[key]
+            section[keys[-1]] = value
+        return config
+
+    def serve(self):
+        """Serve the repository over http on localhost, returns its uri."""
+        self.server = _RepoServer(('127.0.0.1', 0), _RepoHandler)
+        self.server.root = self.repo.dirname
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def profile(self, config):
+        """Write the package profile of the roots of the repository."""
+        dirname = config['profile']['dir']
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'bench.profile'), 'w') as fh:
+            print >>fh, '#include bench.list'
+        with open(os.path.join(dirname, 'bench.list'), 'w') as fh:
+            for name in self.repo.roots():
+                print >>fh, name
+
+    def base(self, config):
+        """Store the base in the bootstrap cache, as the snapshot of the
+        bootstrap of the configuration."""
+        chroot = Chroot(rootdir=os.path.join(self.dirname, self.arch),
+                        architecture=self.arch, config=config['chroot'])
+        key = chroot.bootstrap_key()
+        if key is None:
+            raise BenchError('failed to read the repository Release file')
+        cache = fll.cache.Cache(dirname=config['chroot']['cache']['dir'],
+                                size=config['chroot']['cache']['size'])
+        if cache.lookup(key):
+            return
+
+        packages = list()
+        for comp in self.compression:
+            packages.extend(self.depends.get(comp, []))
+        tmpdir = cache.mkdtemp()
+        try:
+            snapshot = os.path.join(tmpdir, 'bootstrap.tar')
+            Base(packages=packages, keyring=self.repo.keyring).write(snapshot)
+            cache.store(key, snapshot, move=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def run(self, runs=1):
+        """Benchmark runs builds. Returns a list of dicts of the wall time
+        of each phase, for each run. The trace of the last run is written
+        to <dirname>/bench.trace.json."""
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+
+        results = list()
+        fll.trace.enable()
+        try:
+            with fll.trace.span('bench repo'):
+                self.repo.generate()
+            uri = self.http and self.serve() or self.repo.uri()
+            config = self.config(uri)
+            os.environ.update(config['environment'])
+            self.profile(config)
+            with fll.trace.span('bench base'):
+                self.base(config)
+
+            for n in range(runs):
+                if n > 0:
+                    fll.trace.reset()
+                with fll.trace.span('build'):
+                    self.build(config)
+                results.append(dict([(name, wall) for (cat, name),
+                                     (count, wall, cpu, rss, i, o) in
+                                     fll.trace.totals().iteritems()
+                                     if cat == 'phase']))
+                print 'BENCH run %d: %.2fs' % (n + 1, results[-1]['build'])
+        finally:
+            if self.server:
+                self.server.shutdown()
+                self.server.server_close()
+            try:
+                fll.trace.write(os.path.join(self.dirname,
+                                             'bench.trace.json'))
+            except fll.trace.TraceError, e:
+                print 'BENCH %s' % e
+        return results
+
+    def build(self, config):
+        """Build a chroot with fll.build.build(), as bin/fll does, with the
+        l10n packages PkgMod selects for the locales of the repository."""
+        fll.build.build(config, self.arch,
+                        localesmap=self.repo.localesmap())
@@ -0,0 +1,80 @@
+"""
+This is the fll.build module, it builds the chroot filesystem of an
+architecture from the other fll modules. It is shared by bin/fll and
+fll.bench, so that a benchmark measures the build bin/fll runs.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+from fll.aptlib import AptLib
+from fll.chroot import Chroot
+from fll.distro import Distro
+from fll.fscomp import FsComp
+from fll.pkgmod import PkgMod
+from fll.plan import Prefetch
+
+import os
+
+import fll.trace
+
+
+def build(config, arch, localesmap=None):
+    """Build the chroot filesystem of arch in <dir>/<arch> and compress it.
+    config is the config of an fll.config.Config object, localesmap is as
+    per fll.pkgmod.PkgMod."""
+    rootdir = os.path.join(config['dir'], arch)
+
+    # The archives of the packages are fetched into the package pool while
+    # the chroot is bootstrapped and initialised, if prefetching.
+    with Prefetch(architecture=arch, config=config) as prefetch, \
+         Chroot(rootdir=rootdir, architecture=arch,
+                config=config['chroot']) as chroot:
+        # Each stage is skipped if its layer is found in the layer store
+        # of a layered chroot.
+        if not chroot.layer('bootstrap', chroot.bootstrap_key):
+            chroot.bootstrap()
+            chroot.promote()
+
+        if not chroot.layer('init', chroot.config['hostname'],
+                            chroot.diverts, chroot.config['unsafeio']):
+            chroot.init()
+            chroot.promote()
+
+        apt = AptLib(chroot=chroot, config=config['apt'])
+        prefetch.join()
+
+        common = config['chroot']['layers']['packages']
+        if common:
+            if chroot.layer('common', apt.index_key, apt.conf_key,
+                            sorted(common)):
+                apt.open()
+            else:
+                apt.install(common)
+                chroot.promote()
+
+        with fll.trace.span('profile'):
+            pm = PkgMod(aptlib=apt, architecture=arch,
+                        config=config['profile'],
+                        locales=config['profile']['locales'],
+                        localesmap=localesmap)
+        fscomp = FsComp(chroot=chroot, config=config['fscomp'])
+        pm.pkgs.update(fscomp.depends)
+
+        if chroot.layer('profile', apt.index_key, apt.conf_key,
+                        sorted(pm.pkgs)):
+            apt.open()
+        else:
+            apt.install(pm.pkgs, commit=False)
+            for change in apt.changes():
+                print change
+            apt.commit()
+            chroot.promote()
+
+        dist = Distro(chroot=chroot, config=config['distro'])
+        dist.init()
+
+        apt.deinit()
+        chroot.deinit()
+        fscomp.compress()
@@ -0,0 +1,217 @@
+"""
+This is the fll.cache module, it provides a class for managing a directory
+of build artifacts which may be shared between builds and evicted on a
+least recently used basis.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+from contextlib import contextmanager
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+import fll.misc
+
+
+class CacheError(Exception):
+    """
+    An Error class for use by Cache.
+    """
+    pass
+
+
+def digest(*args):
+    """Return a sha256 hex digest of args. Lists and tuples are joined with
+    a comma, so that they contribute to the digest in a stable way."""
+    h = hashlib.sha256()
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            arg = ','.join(arg)
+        h.update('%s\0' % arg)
+    return h.hexdigest()
+
+
+class Cache(object):
+    """
+    A class for managing a directory of cached entries. Each entry is a
+    file or directory named by its key, with a <key>.size file recording
+    its size. The modification time of the .size file is its last use.
+    Several builds may share a cache, all changes are made under an
+    exclusive lock and entries appear atomically.
+
+    Options   Type   Description
+    --------------------------------------------------------------------------
+    dirname - (str)  path to cache directory
+    size    - (int)  size budget in MB, 0 means unlimited
+    """
+    def __init__(self, dirname=None, size=0):
+        if not dirname:
+            raise CacheError('must specify dirname=')
+
+        self.dirname = os.path.realpath(dirname)
+        self.size = size * 2**20
+
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+        except OSError, e:
+            raise CacheError('failed to create cache: %s' % e)
+
+    def path(self, key):
+        return os.path.join(self.dirname, key)
+
+    @contextmanager
+    def lock(self, shared=False):
+        """Hold a lock on the cache for the duration of a with block."""
+        fh = open(os.path.join(self.dirname, '.lock'), 'a')
+        try:
+            fcntl.flock(fh, shared and fcntl.LOCK_SH or fcntl.LOCK_EX)
+            yield
+        finally:
+            fh.close()
+
+    def pin(self, key):
+        """Prevent eviction of an entry while it is in use. Returns an
+        object to be given to unpin()."""
+        fh = open(self.path(key) + '.pin', 'a')
+        fcntl.flock(fh, fcntl.LOCK_SH)
+        return fh
+
+    def unpin(self, pin):
+        pin.close()
+
+    def lookup(self, key):
+        """Return path to entry of key and mark it as recently used, or
+        None if there is no such entry."""
+        with self.lock(shared=True):
+            if not os.path.exists(self.path(key) + '.size'):
+                return None
+            try:
+                os.utime(self.path(key) + '.size', None)
+            except OSError:
+                pass
+            return self.path(key)
+
+    def mkdtemp(self):
+        """Return a temporary directory within the cache. Use it to stage
+        entries so that store() is an atomic rename."""
+        return tempfile.mkdtemp(dir=self.dirname, prefix='.tmp')
+
+    def store(self, key, src, move=False, evict=True, replace=False):
+        """Store src in the cache as the entry of key. src is hardlinked
+        or copied into the cache, or renamed if move is True. The entry
+        is left untouched if another build stored it first, unless replace
+        is True. When storing
+        many entries, pass evict=False and call evict() once after. Returns
+        path to the entry."""
+        tmpdir = self.mkdtemp()
+        tmp = os.path.join(tmpdir, key)
+        try:
+            if move:
+                try:
+                    os.rename(src, tmp)
+                except OSError, e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    fll.misc.cmd(['cp', '-a', src, tmp], silent=True)
+            elif os.path.isdir(src):
+                fll.misc.cmd(['cp', '-a', src, tmp], silent=True)
+            else:
+                try:
+                    os.link(src, tmp)
+                except OSError:
+                    shutil.copy2(src, tmp)
+
+            size = self._du(tmp)
+
+            with self.lock():
+                if replace or \
+                   not os.path.exists(self.path(key) + '.size'):
+                    if os.path.lexists(self.path(key)):
+                        self._remove(key)
+                    os.rename(tmp, self.path(key))
+                    with open(self.path(key) + '.size', 'w') as fh:
+                        print >>fh, size
+        except (IOError, OSError), e:
+            raise CacheError('failed to store %s in cache: %s' % (key, e))
+        finally:
+            self._rmtree(tmpdir)
+
+        if evict:
+            self.evict(keep=key)
+        return self.path(key)
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache is within its
+        size budget. Pinned entries and the entry of keep are not removed."""
+        if self.size <= 0:
+            return
+
+        with self.lock():
+            entries = list()
+            total = 0
+            for f in os.listdir(self.dirname):
+                if not f.endswith('.size'):
+                    continue
+                fname = os.path.join(self.dirname, f)
+                try:
+                    with open(fname) as fh:
+                        size = int(fh.read().strip() or 0)
+                    entries.append((os.stat(fname).st_mtime, size, f[:-5]))
+                except (IOError, OSError, ValueError):
+                    continue
+                total += size
+
+            entries.sort()
+            for mtime, size, key in entries:
+                if total <= self.size:
+                    break
+                if key == keep or self._pinned(key):
+                    continue
+                print 'CACHE evict %s [%d]' % (self.path(key), size)
+                self._remove(key)
+                total -= size
+
+    def _pinned(self, key):
+        if not os.path.exists(self.path(key) + '.pin'):
+            return False
+        with open(self.path(key) + '.pin', 'a') as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+        return False
+
+    def _remove(self, key):
+        for suffix in ('.size', '.pin', ''):
+            fname = self.path(key) + suffix
+            if os.path.isdir(fname) and not os.path.islink(fname):
+                self._rmtree(fname)
+            elif os.path.lexists(fname):
+                os.unlink(fname)
+
+    def _rmtree(self, path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def _du(self, path):
+        """Return disk usage of path in bytes."""
+        if not os.path.isdir(path) or os.path.islink(path):
+            return os.lstat(path).st_blocks * 512
+        size = 0
+        seen = set()
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                st = os.lstat(os.path.join(root, name))
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_blocks * 512
+        return size
@@ -7,7 +7,15 @@ Copyright: Copyright (C) 2010 Kel Modderman <kel@otaku42.de>
 License:   GPL-2
 """
 
+from distutils.spawn import find_executable
+
+import cPickle
+import fll.cache
+import fll.executor
 import fll.misc
+import fll.trace
+import glob
+import hashlib
 import os
 import subprocess
 import shlex
@@ -15,6 +23,9 @@ import shutil
 import signal
 import sys
 import tempfile
+import threading
+import time
+import urllib2
 
 
 class ChrootError(Exception):
@@ -24,6 +35,77 @@ class ChrootError(Exception):
     pass
 
 
+class ChrootExecutor(object):
+    """
+    A helper process which chroots once and then executes batches of
+    commands sent to it over a pipe. The helper is a fresh interpreter
+    serving fll.executor.serve(), so each chrooted command is forked from a
+    small process rather than from the (large) build process, and needs no
+    chroot(2) via preexec_fn. It may be shared by threads, batches are
+    executed one at a time. A thread which does not wait for another's
+    batch to complete may execute its batch without the helper.
+
+    Options   Type   Description
+    --------------------------------------------------------------------------
+    rootdir - (str)  path to root of chroot
+    """
+    server = 'import sys; sys.path.insert(0, sys.argv[1]); ' \
+             'import fll.executor; fll.executor.serve(sys.argv[2], ' \
+             'int(sys.argv[3]), int(sys.argv[4]))'
+
+    def __init__(self, rootdir=None):
+        if rootdir is None:
+            raise ChrootError('must specify rootdir=')
+
+        req_r, req_w = os.pipe()
+        rep_r, rep_w = os.pipe()
+        path = os.path.dirname(os.path.dirname(
+            os.path.abspath(fll.executor.__file__)))
+        argv = [sys.executable, '-S', '-c', self.server, path, rootdir,
+                str(req_r), str(rep_w)]
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                # keep only stdio and the pipes of the helper
+                keep = sorted([req_r, rep_w])
+                os.closerange(3, keep[0])
+                os.closerange(keep[0] + 1, keep[1])
+                os.closerange(keep[1] + 1, subprocess.MAXFD)
+                os.execv(sys.executable, argv)
+            finally:
+                os._exit(1)
+
+        os.close(req_r)
+        os.close(rep_w)
+        self._lock = threading.Lock()
+        self._req = os.fdopen(req_w, 'wb')
+        self._rep = os.fdopen(rep_r, 'rb')
+
+    def run(self, batch, jobs=1, env=None, wait=True):
+        """Execute a batch of commands as per fll.executor.execute_batch().
+        If wait is False and the helper is busy, returns None instead."""
+        if not self._lock.acquire(wait):
+            return None
+        try:
+            cPickle.dump((batch, jobs, env, fll.trace.enabled()), self._req,
+                         2)
+            self._req.flush()
+            return cPickle.load(self._rep)
+        except (EOFError, IOError, cPickle.UnpicklingError), e:
+            raise ChrootError('chroot executor failed: %s' % e)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Stop the helper process."""
+        self._req.close()
+        os.waitpid(self.pid, 0)
+        self._rep.close()
+
+
 class Chroot(object):
     """
     A class which provides the ability to bootstrap and execute commands
@@ -38,6 +120,10 @@ class Chroot(object):
     diverts = ['/usr/sbin/policy-rc.d', '/sbin/modprobe', '/sbin/insmod',
                '/usr/sbin/update-grub', '/usr/sbin/update-initramfs',
                '/sbin/initctl', '/sbin/start-stop-daemon']
+    unsafeio_cfg = '/etc/dpkg/dpkg.cfg.d/fll-unsafe-io'
+    # fsync() suppressing preload of unsafe-io mode, built from
+    # data/fll-nosync.c
+    nosync = '/.fll-nosync/libfll-nosync.so'
 
     def __init__(self, rootdir=None, architecture=None, config={}):
         if rootdir is None:
@@ -50,19 +136,145 @@ class Chroot(object):
         self.rootdir = os.path.realpath(rootdir)
         self.architecture = architecture
         self.config = config
+        # Virtual filesystems are mounted on first use and kept mounted
+        # while they are referenced, or for the life of a with block.
         self.mounted = list()
+        self._vfsref = 0
+        self._session = False
+        self._executor = None
+        self._tmpfs = False
+        self._unsafeio = self.config['unsafeio']
+        # whether the nosync preload is in the chroot, None if unknown
+        self._nosync = None
+        self._nosync_disabled = False
+        self.unsafeio_saved = 0
+        # Guards mount and executor state, Chroot may be shared by threads.
+        self._lock = threading.RLock()
+        self._bootstrap_key = None
+
+        # Stack of (path, pin) of layers mounted beneath rootdir, topmost
+        # first, and digest identifying the stack.
+        self.layers = list()
+        self.layer_key = ''
+        self.layer_store = None
+        self.layered = False
+        self._layer_next = None
+        if self.config['layers']['dir']:
+            try:
+                self.layer_store = fll.cache.Cache(
+                    dirname=self.config['layers']['dir'],
+                    size=self.config['layers']['size'])
+            except fll.cache.CacheError, e:
+                raise ChrootError(e)
+            self.layered = True
 
     def __enter__(self):
+        self._session = True
         return self
 
     def __exit__(self, type, value, traceback):
-        self.umountvirtfs()
+        self._session = False
+        self._executor_stop()
+        self.umountvirtfs(force=True)
         if not self.config['preserve']:
             self.nuke()
 
+    @fll.trace.traced('bootstrap')
     def bootstrap(self):
         """Bootstrap a Debian chroot. By default it will bootstrap a minimal
-        sid chroot with cdebootstrap."""
+        sid chroot with cdebootstrap. If a bootstrap cache is configured,
+        the chroot is restored from a snapshot of an identical bootstrap
+        when one is available."""
+        self._mounttmpfs()
+
+        cache = key = None
+        if self.config['cache']['dir']:
+            try:
+                cache = fll.cache.Cache(dirname=self.config['cache']['dir'],
+                                        size=self.config['cache']['size'])
+            except fll.cache.CacheError, e:
+                raise ChrootError(e)
+            key = self.bootstrap_key()
+
+        if key and self._bootstrap_restore(cache, key):
+            return
+
+        # the preload is not part of the bootstrap, nor of its snapshot
+        env = self._nosync_install() and self._nosync_env() or None
+        try:
+            self._bootstrap(env=env)
+        finally:
+            self._nosync_remove()
+
+        if key:
+            self._bootstrap_snapshot(cache, key)
+
+    def bootstrap_key(self):
+        """Return a digest of everything which determines the result of
+        bootstrap(), including the hash of the Release file of the suite.
+        Returns None if the Release file could not be fetched."""
+        if self._bootstrap_key is not None:
+            return self._bootstrap_key
+
+        config = self.config['bootstrap']
+        release = '%s/dists/%s/Release' % (config['uri'].rstrip('/'),
+                                           config['suite'])
+        try:
+            fh = urllib2.urlopen(release, timeout=60)
+            try:
+                release_hash = hashlib.sha256(fh.read()).hexdigest()
+            finally:
+                fh.close()
+        except (urllib2.URLError, IOError, ValueError), e:
+            print 'HOST bootstrap cache disabled: %s: %s' % (release, e)
+            return None
+
+        self._bootstrap_key = fll.cache.digest(config['utility'],
+            config['suite'], config['flavour'], config['include'],
+            config['exclude'], self.architecture, config['uri'],
+            release_hash)
+        return self._bootstrap_key
+
+    def _bootstrap_restore(self, cache, key):
+        """Restore the chroot from a bootstrap snapshot. Returns False if
+        there is no snapshot for key."""
+        pin = cache.pin(key)
+        try:
+            snapshot = cache.lookup(key)
+            if snapshot is None:
+                return False
+            print 'HOST restore bootstrap %s' % snapshot
+            if not os.path.isdir(self.rootdir):
+                os.makedirs(self.rootdir)
+            fll.misc.cmd(['tar', '--extract', '--preserve-permissions',
+                          '--numeric-owner', '--xattrs',
+                          '--xattrs-include=*', '-f', snapshot,
+                          '-C', self.rootdir], silent=True)
+        except OSError, e:
+            raise ChrootError('failed to restore bootstrap snapshot: %s' % e)
+        finally:
+            cache.unpin(pin)
+        return True
+
+    def _bootstrap_snapshot(self, cache, key):
+        """Store a snapshot of the freshly bootstrapped chroot. Failure to
+        do so is not fatal to the build."""
+        tmpdir = cache.mkdtemp()
+        try:
+            snapshot = os.path.join(tmpdir, 'bootstrap.tar')
+            fll.misc.cmd(['tar', '--create', '--one-file-system',
+                          '--numeric-owner', '--xattrs', '-f', snapshot,
+                          '-C', self.rootdir, '.'], silent=True)
+            print 'HOST store bootstrap %s' % cache.store(key, snapshot,
+                                                         move=True)
+        except (OSError, fll.cache.CacheError), e:
+            print 'HOST failed to store bootstrap snapshot: %s' % e
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _bootstrap(self, env=None):
+        """Run the bootstrap utility, in the environment env if it is not
+        None."""
         utility = self.config['bootstrap']['utility']
         uri = self.config['bootstrap']['uri']
         suite = self.config['bootstrap']['suite']
@@ -107,7 +319,7 @@ class Chroot(object):
         cmd.append(uri)
 
         try:
-            fll.misc.cmd(cmd)
+            fll.misc.cmd(cmd, env=env)
         except OSError:
             raise ChrootError('bootstrap command failed: %s' % ' '.join(cmd))
 
@@ -117,6 +329,161 @@ class Chroot(object):
             self.cmd('dpkg --purge cdebootstrap-helper-rc.d'.split(),
                      silent=self.config['quiet'])
 
+    def _mounttmpfs(self):
+        """Mount a tmpfs at rootdir, if configured and the host has enough
+        available memory for it. require_space() moves the chroot to disk
+        if it turns out to be too small."""
+        size = self.config['tmpfs']['size']
+        if size <= 0 or self.layered or self._tmpfs:
+            return
+
+        available = 0
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) / 1024
+        if available < size:
+            print 'HOST tmpfs %dM not used, %dM memory available' % \
+                (size, available)
+            return
+
+        if not os.path.isdir(self.rootdir):
+            os.makedirs(self.rootdir)
+        try:
+            fll.misc.mount('tmpfs', self.rootdir, 'tmpfs', 0,
+                           'size=%dm,mode=0755' % size)
+        except OSError, e:
+            raise ChrootError('failed to mount tmpfs: %s' % e)
+        print 'HOST tmpfs %dM mounted at %s' % (size, self.rootdir)
+        self._tmpfs = True
+
+    def require_space(self, nbytes):
+        """Declare that nbytes more will be written to the chroot. If the
+        chroot is on a tmpfs with less free space than that, it is moved to
+        disk."""
+        if not self._tmpfs:
+            return
+
+        st = os.statvfs(self.rootdir)
+        free = st.f_bavail * st.f_frsize
+        # Leave headroom for temporary files and estimation error.
+        if nbytes * 1.1 < free:
+            return
+
+        print 'HOST tmpfs %s has %dM free, %dM required, moving to disk' % \
+            (self.rootdir, free / 2**20, nbytes / 2**20)
+        spill = self._layer_path('spill')
+        with self._lock:
+            self._executor_stop()
+            self._umountvirtfs()
+            try:
+                os.mkdir(spill)
+                fll.misc.cmd(['cp', '-a', self.rootdir + '/.', spill],
+                             silent=True)
+            except OSError, e:
+                raise ChrootError('failed to move chroot to disk: %s' % e)
+            self.umountall()
+            os.rmdir(self.rootdir)
+            os.rename(spill, self.rootdir)
+            self._tmpfs = False
+
+    def layer(self, name, *inputs):
+        """Begin the build stage name of a layered chroot. inputs are all
+        values which determine the result of the stage, the inputs of
+        previous stages are implied. If the layer store has a layer for the
+        stage it is mounted beneath rootdir and True is returned, the stage
+        need not be run. Otherwise False is returned, the stage should be
+        run and then promote()d. Always returns False if the chroot is not
+        layered. Callable inputs are called, so that they are computed
+        only for layered chroots. If any input is None the stage cannot be
+        identified, and the chroot is not layered from then on."""
+        if not self.layered:
+            return False
+
+        inputs = [i() if callable(i) else i for i in inputs]
+
+        if None in inputs:
+            print 'CHROOT %s layering disabled at stage %s' % \
+                (self.rootdir, name)
+            self.layered = False
+            self._mountlayers()
+            return False
+
+        key = fll.cache.digest(self.layer_key, name, *inputs)
+        pin = self.layer_store.pin(key)
+        path = self.layer_store.lookup(key)
+        if path is None:
+            self.layer_store.unpin(pin)
+            self._layer_next = key
+            self._mountlayers()
+            return False
+
+        print 'CHROOT %s layer %s %s' % (self.rootdir, name, path)
+        self.layers.insert(0, (path, pin))
+        self.layer_key = key
+        self._layer_next = None
+        self._mountlayers()
+        return True
+
+    @fll.trace.traced('promote')
+    def promote(self):
+        """Complete the build stage begun with layer(). Everything written
+        to the chroot since the previous layer is moved into a new layer of
+        the layer store, for use by other builds."""
+        if not self.layered or self._layer_next is None:
+            return
+
+        key = self._layer_next
+        self._layer_next = None
+        self._umountlayers()
+
+        try:
+            path = self.layer_store.store(key, self._layer_path('upper'),
+                                          move=True)
+        except fll.cache.CacheError, e:
+            raise ChrootError(e)
+        print 'CHROOT %s promote %s' % (self.rootdir, path)
+
+        self.layers.insert(0, (path, self.layer_store.pin(key)))
+        self.layer_key = key
+        self._mountlayers()
+
+    def _layer_path(self, name):
+        return '%s.%s' % (self.rootdir, name)
+
+    def _mountlayers(self):
+        """Mount rootdir as an overlay of the layer stack, with a writable
+        upper directory. Virtual filesystems are mounted again on next
+        use."""
+        self._umountlayers()
+        self._nosync = None
+
+        for d in ('lower', 'upper', 'work'):
+            if not os.path.isdir(self._layer_path(d)):
+                os.makedirs(self._layer_path(d))
+        if not os.path.isdir(self.rootdir):
+            os.makedirs(self.rootdir)
+
+        lower = [path for path, pin in self.layers]
+        if not lower:
+            lower.append(self._layer_path('lower'))
+
+        opts = 'lowerdir=%s,upperdir=%s,workdir=%s' % \
+            (':'.join(lower), self._layer_path('upper'),
+             self._layer_path('work'))
+        try:
+            fll.misc.mount('overlay', self.rootdir, 'overlay', 0, opts)
+        except OSError, e:
+            raise ChrootError('failed to mount layers: %s' % e)
+
+    def _umountlayers(self):
+        """Unmount the overlay at rootdir, if mounted."""
+        self._executor_stop()
+        self._umountvirtfs()
+        self.umountall()
+        if os.path.isdir(self._layer_path('work')):
+            shutil.rmtree(self._layer_path('work'))
+
     def debconf_set_selections(self, selections):
         dss = '/usr/bin/debconf-set-selections'
 
@@ -135,6 +502,7 @@ class Chroot(object):
             cmd.append(self.chroot_path_rel(fh.name))
             self.cmd(cmd)
 
+    @fll.trace.traced('init')
     def init(self):
         """Configure the basics to get a functioning chroot."""
         self.mountvirtfs()
@@ -147,18 +515,29 @@ class Chroot(object):
                       '/etc/network/interfaces'):
             self.create_file(fname)
 
+        if self._unsafeio:
+            self.create_file(self.unsafeio_cfg)
+            self._nosync_install()
+
+        cmds = list()
         for fname in self.diverts:
             cmd = 'dpkg-divert --add --local --divert ' + fname + '.REAL'
             cmd += ' --rename ' + fname
-            self.cmd(cmd, silent=self.config['quiet'])
+            cmds.append(cmd)
+        self.cmds(cmds, silent=self.config['quiet'])
+        for fname in self.diverts:
             self.create_file(fname, mode=0755)
 
         debconf = ['man-db man-db/auto-update boolean false']
         self.debconf_set_selections(debconf)
 
+    @fll.trace.traced('deinit')
     def deinit(self):
         """Undo any changes in the chroot which should be undone. Make any
         final configurations."""
+        if self._unsafeio:
+            self._unsafeio_deinit()
+
         for fname in ('/etc/hosts', '/etc/resolv.conf', '/etc/machine-id'):
             # /etc/resolv.conf (and possibly others) may be a symlink to an 
             # absolute path - so do not clobber the host's configuration.
@@ -166,10 +545,11 @@ class Chroot(object):
                 continue
             self.create_file(fname)
 
+        cmds = list()
         for fname in self.diverts:
             os.unlink(self.chroot_path(fname))
-            cmd = 'dpkg-divert --remove --rename ' + fname
-            self.cmd(cmd, silent=self.config['quiet'])
+            cmds.append('dpkg-divert --remove --rename ' + fname)
+        self.cmds(cmds, silent=self.config['quiet'])
 
         debconf = ['man-db man-db/auto-update boolean true']
         self.debconf_set_selections(debconf)
@@ -178,13 +558,115 @@ class Chroot(object):
 
         self.makeInitramfs()
         self.umountvirtfs()
-
-    def hookitems(self,hook,items):
-        """run hook with each item"""
+        self._unsafeio = False
+
+    def _unsafeio_deinit(self):
+        """Remove the unsafe-io configuration and the nosync preload from
+        the chroot, and estimate the time they saved: an fsync() of each
+        file installed by dpkg, timed on the filesystem of the chroot. The
+        estimate is recorded in the trace."""
+        if os.path.exists(self.chroot_path(self.unsafeio_cfg)):
+            os.unlink(self.chroot_path(self.unsafeio_cfg))
+        self._nosync_remove()
+
+        files = 0
+        for fname in glob.glob(self.chroot_path('/var/lib/dpkg/info/*.list')):
+            with open(fname) as fh:
+                files += sum(1 for line in fh)
+
+        fd, fname = tempfile.mkstemp(dir=self.chroot_path('/tmp'))
+        try:
+            samples = 16
+            start = time.time()
+            for i in range(samples):
+                os.write(fd, os.urandom(4096))
+                os.fsync(fd)
+            fsync = (time.time() - start) / samples
+        finally:
+            os.close(fd)
+            os.unlink(fname)
+
+        self.unsafeio_saved = files * fsync
+        fll.trace.estimate('unsafe-io saved', self.unsafeio_saved,
+                           files=files, fsync_ms=round(fsync * 1000, 2))
+        print 'CHROOT %s unsafe-io saved ~%ds (estimated: %d files, ' \
+            '%.1fms per fsync)' % (self.rootdir, self.unsafeio_saved, files,
+                                   fsync * 1000)
+
+    def _nosync_install(self):
+        """Build the nosync preload into the chroot, in unsafe-io mode. It
+        is built with the C compiler of the host, so only for a chroot of
+        the architecture of the host. Returns True if it was built."""
+        self._nosync = False
+        if not self._unsafeio or self._nosync_disabled:
+            return False
+
+        source = 'data/fll-nosync.c'
+        if not os.path.isfile(source):
+            source = '/usr/share/fll/data/fll-nosync.c'
+        path = self.chroot_path(self.nosync)
+        try:
+            host = fll.misc.cmd('dpkg --print-architecture', pipe=True,
+                                silent=True).strip()
+            if host != self.architecture:
+                raise OSError('chroot is not of the host architecture')
+            if not find_executable('cc'):
+                raise OSError('no C compiler (cc) on the host')
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fll.misc.cmd(['cc', '-shared', '-fPIC', '-nostdlib', '-O2',
+                          '-o', path, source], silent=True)
+        except OSError, e:
+            print 'CHROOT %s unsafe-io preload disabled: %s' % \
+                (self.rootdir, e)
+            self._nosync_disabled = True
+            self._nosync_remove()
+            return False
+
+        self._nosync = True
+        return True
+
+    def _nosync_remove(self):
+        """Remove the nosync preload from the chroot."""
+        dirname = self.chroot_path(os.path.dirname(self.nosync))
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        self._nosync = False
+
+    def _nosync_env(self):
+        """Return the environment of the bootstrap utility with the nosync
+        preload. The utility runs commands both on the host and in the
+        chroot, so the preload is found by name in its directory in the
+        chroot, as seen from either."""
+        dirname = os.path.dirname(self.nosync)
+        path = [self.chroot_path(dirname), dirname]
+        if os.environ.get('LD_LIBRARY_PATH'):
+            path.append(os.environ['LD_LIBRARY_PATH'])
+        return dict(os.environ, LD_PRELOAD=os.path.basename(self.nosync),
+                    LD_LIBRARY_PATH=':'.join(path))
+
+    def hookitems(self,hook,items,jobs=None):
+        """run hook with each item, up to jobs (default: the chroot jobs
+        setting) at a time. The output of concurrent hooks is captured and
+        printed, item by item, once all have completed."""
         # e.g. self.makeImages('/etc/kernel/postinst.d/zs-sunxi-image',self.detectLinuxVersions())
         print "running command >>> %s <<< for each item >>> %s <<<" % (hook, ", ".join(items))
-        for i in items:
-            self.cmd(hook % i)
+        if jobs is None:
+            jobs = self.config['jobs']
+        if jobs <= 1 or len(items) <= 1:
+            for i in items:
+                self.cmd(hook % i)
+            return
+
+        cmds = [shlex.split(hook % i) for i in items]
+        results = self._run([(cmd, True, False, True) for cmd in cmds],
+                            jobs=jobs)
+        for cmd, (returncode, output) in zip(cmds, results):
+            print 'CHROOT %s %s' % (self.rootdir, ' '.join(cmd))
+            if output:
+                sys.stdout.write(output)
+        for cmd, (returncode, output) in zip(cmds, results):
+            self._check(cmd, returncode, output)
 
     def detectLinuxVersions(self):
          """Return version string of installed vmlinu[xz]-*"""
@@ -194,6 +676,7 @@ class Chroot(object):
          kvers.sort
          return(kvers)
  
+    @fll.trace.traced('initramfs')
     def makeInitramfs(self):
         """Generate the initramfs if update-initramfs was diverted"""
         hook = '/usr/sbin/update-initramfs'
@@ -224,6 +707,11 @@ echo "Command denied: $0 $@" 1>&2
 echo 1>&2
 exit %d""" % retv
 
+            elif filename == self.unsafeio_cfg:
+                print >>fh, """\
+# Written by fll, removed at the end of the build.
+force-unsafe-io"""
+
             elif filename == '/etc/fstab':
                 print >>fh, """\
 # /etc/fstab: static file system information."""
@@ -257,27 +745,47 @@ iface lo inet loopback"""
                 os.chmod(self.chroot_path(filename), mode)
 
     def mountvirtfs(self):
-        """Mount /sys, /proc, /dev/pts virtual filesystems in the chroot."""
-        if len(self.mounted) > 0:
-            return(0)
-
-        virtfs = {'devpts': '/dev/pts', 'proc': '/proc', 'sysfs': '/sys'}
-
-        for vfstype, mnt in virtfs.items():
-            cmd = ['mount', '-t', vfstype, 'none', self.chroot_path(mnt)]
-            try:
-                subprocess.check_call(cmd, preexec_fn=fll.misc.restore_sigpipe)
-                self.mounted.append(self.chroot_path(mnt))
-            except (subprocess.CalledProcessError, OSError):
-                raise ChrootError('failed to mount virtfs: ' + mnt)
-        return(len(self.mounted))
-
-    def umountvirtfs(self):
+        """Mount /sys, /proc, /dev/pts virtual filesystems in the chroot,
+        if not already mounted. Each call must be paired with a call of
+        umountvirtfs(). Returns the number of references to the mounts."""
+        with self._lock:
+            self._vfsref += 1
+            if len(self.mounted) > 0:
+                return self._vfsref
+
+            virtfs = [('devpts', '/dev/pts'), ('proc', '/proc'),
+                      ('sysfs', '/sys')]
+
+            for vfstype, mnt in virtfs:
+                try:
+                    fll.misc.mount('none', self.chroot_path(mnt), vfstype)
+                    self.mounted.append(self.chroot_path(mnt))
+                except OSError, e:
+                    self._vfsref -= 1
+                    self._umountvirtfs()
+                    raise ChrootError('failed to mount virtfs: %s' % e)
+            return self._vfsref
+
+    def umountvirtfs(self, force=False):
+        """Release a reference to the virtual filesystems mounted within the
+        chroot. They are unmounted when no references remain, unless in a
+        with block. If force is True they are unmounted regardless."""
+        with self._lock:
+            if force:
+                self._vfsref = 0
+            elif self._vfsref > 0:
+                self._vfsref -= 1
+
+            if force or (self._vfsref == 0 and not self._session):
+                self._umountvirtfs()
+
+    def _umountvirtfs(self):
         """Unmount virtual filesystems that are mounted within the chroot."""
-        umount = self.mounted
-        umount.reverse()
-        self._umount(umount)
-        self.mounted = list()
+        with self._lock:
+            umount = self.mounted
+            umount.reverse()
+            self.mounted = list()
+            self._umount(umount)
 
     def umountall(self):
         """Unmount all filesystems that are mounted within the chroot."""
@@ -298,23 +806,30 @@ iface lo inet loopback"""
 
         for mnt in umount:
             try:
-                subprocess.check_call(['umount', mnt],
-                                      preexec_fn=fll.misc.restore_sigpipe)
-            except (subprocess.CalledProcessError, OSError):
-                raise ChrootError('failed to umount virtfs: ' + mnt)
+                fll.misc.umount(mnt, lazy=True)
+            except OSError, e:
+                raise ChrootError('failed to umount: %s' % e)
 
     def nuke(self):
         """Remove the chroot from filesystem. All mount points in chroot
         will be umounted prior to attempted removal."""
+        self._executor_stop()
         self.umountall()
 
         try:
             if os.path.isdir(self.rootdir):
                 print 'HOST nuke(%s)' % self.rootdir
                 shutil.rmtree(self.rootdir)
+            for d in ('lower', 'upper', 'work', 'spill'):
+                if os.path.isdir(self._layer_path(d)):
+                    shutil.rmtree(self._layer_path(d))
         except IOError:
             raise ChrootError('failed to nuke chroot: ' + self.rootdir)
 
+        for path, pin in self.layers:
+            self.layer_store.unpin(pin)
+        self.layers = list()
+
     def _chroot(self):
         """Convenience function so that subprocess may be executed in chroot
         via preexec_fn. Restore SIGPIPE."""
@@ -322,44 +837,99 @@ iface lo inet loopback"""
         os.chroot(self.rootdir)
         os.chdir('/')
 
+    def _executor_start(self):
+        """Return the chroot executor, starting it if enabled and not yet
+        running."""
+        with self._lock:
+            if self._executor is None and self.config['executor']:
+                self._executor = ChrootExecutor(rootdir=self.rootdir)
+            return self._executor
+
+    def _executor_stop(self):
+        """Stop the chroot executor. It holds rootdir as its root, which
+        must be released before rootdir is unmounted."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.close()
+                self._executor = None
+
     def cmd(self, cmd, pipe=False, quiet=False, silent=False):
         """Execute a command in the chroot."""
-        if isinstance(cmd, str):
-            cmd = shlex.split(cmd)
+        output = self.cmds([cmd], pipe=pipe, quiet=quiet, silent=silent)
+        if pipe:
+            return output[0]
 
-        if silent is False:
-            print 'CHROOT %s %s' % (self.rootdir, ' '.join(cmd))
+    def cmds(self, cmds, pipe=False, quiet=False, silent=False, jobs=1):
+        """Execute a batch of commands in the chroot, in order, stopping at
+        the first which fails. If jobs is greater than 1, up to jobs
+        commands are executed concurrently and all of them are executed.
+        The chroot executor, if enabled, executes the whole batch in one
+        request. Returns a list of the output of each command if pipe is
+        True."""
+        cmds = [isinstance(c, str) and shlex.split(c) or c for c in cmds]
 
-        devnull = output = None
+        if silent is False:
+            for cmd in cmds:
+                print 'CHROOT %s %s' % (self.rootdir, ' '.join(cmd))
 
         if quiet is False:
             quiet = self.config['quiet']
 
+        results = self._run([(cmd, pipe, quiet or silent, False)
+                             for cmd in cmds], jobs=jobs)
+
+        output = list()
+        for cmd, (returncode, out) in zip(cmds, results):
+            self._check(cmd, returncode, out)
+            output.append(out)
+
+        if pipe:
+            return output
+
+    def _run(self, batch, jobs=1):
+        """Execute a batch of commands in the chroot as per
+        fll.executor.execute_batch(). Each command is traced, returns a list
+        of (returncode, output) tuples."""
         mounted = self.mountvirtfs()
         try:
-            if pipe:
-                proc = subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/',
-                                        stdout=subprocess.PIPE)
-                output = proc.communicate()[0]
-            elif quiet or silent:
-                devnull = os.open(os.devnull, os.O_RDWR)
-                proc = subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/',
-                                        stdout=devnull)
-                proc.wait()
-            else:
-                proc = subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/')
-                proc.wait()
-        except OSError, e:
-            raise ChrootError('chrooted command failed: %s' % e)
+            executor = self._executor_start()
+            env = self._env()
+            results = None
+            if executor:
+                results = executor.run(batch, jobs=jobs, env=env, wait=False)
+                # None if the executor is busy with the batch of another
+                # thread
+            if results is None:
+                results = fll.executor.execute_batch(batch, jobs=jobs,
+                                                     preexec_fn=self._chroot,
+                                                     env=env)
         finally:
             if mounted > 0:
                 self.umountvirtfs()
-            if devnull:
-                os.close(devnull)
 
-        if proc.returncode != 0:
+        for (cmd, pipe, quiet, stderr), (returncode, output, usage, begin,
+                                         end) in zip(batch, results):
+            fll.trace.add(os.path.basename(cmd[0]), 'chroot', begin, end,
+                          dict(usage, cmd=' '.join(cmd)))
+        return [(returncode, output)
+                for returncode, output, usage, begin, end in results]
+
+    def _env(self):
+        """Return the environment of chrooted commands, or None to inherit
+        the environment. In unsafe-io mode, fsync() and friends are
+        suppressed by the nosync preload, if it is in the chroot."""
+        if not self._unsafeio:
+            return None
+        if self._nosync is None:
+            self._nosync = os.path.exists(self.chroot_path(self.nosync))
+        if not self._nosync:
+            return None
+        return dict(os.environ, LD_PRELOAD=self.nosync)
+
+    def _check(self, cmd, returncode, output):
+        """Raise ChrootError if a command failed."""
+        if returncode is None:
+            raise ChrootError('chrooted command failed: %s' % output)
+        if returncode != 0:
             raise ChrootError('chrooted command returncode=%d: %s' %
-                              (proc.returncode, ' '.join(cmd)))
-
-        if pipe:
-            return output
+                              (returncode, ' '.join(cmd)))
@@ -9,7 +9,7 @@ License:   GPL-2
 
 from configobj import ConfigObj, ConfigObjError, \
                       flatten_errors, get_extra_values
-from validate import Validator
+from validate import ValidateError, Validator
 
 import argparse
 import os
@@ -51,7 +51,9 @@ Examples:
                    dest='dryrun',
                    action='store_true',
                    help="""\
-Dry run mode. Do not perform time consuming processes.""")
+Dry run mode. Plan the build of each architecture without building it: print
+the packages which would be installed, the size of their download and of
+their installation and the estimated size of each compressed image.""")
 
     m = p.add_mutually_exclusive_group()
     m.add_argument('--verbosity',
@@ -104,6 +106,14 @@ Build directory for staging chroot filesystem(s) and resulting output.
 A very large amount of free space is required.
 Default: current working directory""")
 
+    b.add_argument('--jobs', '-j',
+                   type=int,
+                   metavar='<JOBS>',
+                   help="""\
+Number of architectures to build concurrently, each in a worker process
+logging to <DIR>/<ARCH>.log.
+Default: 1""")
+
     b.add_argument('--uid', '-u',
                    type=int,
                    metavar='<UID>',
@@ -116,6 +126,12 @@ Set user ownership of output files to specified UID.""")
                    help="""\
 Set group ownership of output files to specified GID.""")
 
+    b.add_argument('--trace', '-T',
+                   action='store_true',
+                   help="""\
+Time each phase of the build and each command, write a Chrome trace to
+<DIR>/<ARCH>.trace.json and summarise it at the end of the build.""")
+
     d = p.add_argument_group(title='distribution related arguments')
 
     d.add_argument('--archs', '-a',
@@ -193,6 +209,35 @@ Do not do trust verification of apt's sources.""")
 GPG Keyserver to fetch pubkeys from when securing apt.
 Default: wwwkeys.eu.pgp.net""")
 
+    a.add_argument('--apt-prefetch',
+                   action='store_true',
+                   help="""\
+Fetch the archives of the build into the package pool while the chroot is
+bootstrapped. Requires --apt-pool-dir.""")
+
+    a.add_argument('--apt-pool-dir',
+                   dest='apt_pool_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory of a package pool in which fetched archives are kept for use by
+later builds.
+Default: '' (disabled)""")
+
+    a.add_argument('--apt-pool-size',
+                   dest='apt_pool_size',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Size budget in MB of the package pool.
+Default: 8192""")
+
+    a.add_argument('--apt-lists-dir',
+                   dest='apt_lists_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory in which to cache apt's package indexes between builds.
+Default: '' (disabled)""")
+
     a.add_argument('--apt-quiet',
                    action='store_true',
                    help="""\
@@ -232,6 +277,21 @@ Package module directory path name.""")
                     help="""\
 List of package names to append to package profile.""")
 
+    pm.add_argument('--profile-locales',
+                    dest='profile_locales',
+                    nargs='+',
+                    metavar='<LOCALE>',
+                    help="""\
+List of locales (eg. de_DE pt_BR) to append the locale support packages of
+the packages of the profile for.""")
+
+    pm.add_argument('--profile-cache',
+                    dest='profile_cache',
+                    metavar='<DIR>',
+                    help="""\
+Directory in which to cache the packages of parsed profiles between builds.
+Default: '' (disabled)""")
+
     c = p.add_argument_group(title='chroot related arguments')
 
     c.add_argument('--chroot-flavour',
@@ -278,6 +338,53 @@ Comma delimited list of packages to include during bootstrap.
 Comma delimited list of packages to exclude during bootstrap.
 """)
 
+    c.add_argument('--chroot-cache-dir',
+                   dest='chroot_cache_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory in which to cache snapshots of bootstrapped chroots.
+Default: '' (disabled)""")
+
+    c.add_argument('--chroot-cache-size',
+                   dest='chroot_cache_size',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Size budget in MB of the bootstrap cache.
+Default: 4096""")
+
+    c.add_argument('--chroot-layers-dir',
+                   dest='chroot_layers_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory of chroot layers shared between builds. Builds an overlay chroot
+of reusable layers when set.
+Default: '' (disabled)""")
+
+    c.add_argument('--chroot-layers-size',
+                   dest='chroot_layers_size',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Size budget in MB of the chroot layer directory.
+Default: 16384""")
+
+    c.add_argument('--chroot-layers-packages',
+                   dest='chroot_layers_packages',
+                   nargs='+',
+                   metavar='<PACKAGES>',
+                   help="""\
+List of packages common to many profiles, installed as a layer of their own.
+""")
+
+    c.add_argument('--chroot-tmpfs-size',
+                   dest='chroot_tmpfs_size',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Size in MB of a tmpfs to build the chroot in, if memory allows.
+Default: 0 (disabled)""")
+
     c.add_argument('--chroot-preserve', '-P',
                    action='store_true',
                    help="""\
@@ -302,6 +409,28 @@ Select verbose mode for chroot actions, overriding the global verbosity mode.
 Select debug mode for chroot actions, overriding the global verbosity mode.
 """)
 
+    c.add_argument('--chroot-executor',
+                   action='store_true',
+                   help="""\
+Execute chrooted commands via a helper process which chroots only once.
+Default: False""")
+
+    c.add_argument('--chroot-unsafe-io',
+                   dest='chroot_unsafeio',
+                   action='store_true',
+                   help="""\
+Skip fsync() in dpkg and other tools while building the chroot.
+Default: False""")
+
+    c.add_argument('--chroot-jobs',
+                   dest='chroot_jobs',
+                   type=int,
+                   metavar='<JOBS>',
+                   help="""\
+Number of hooks, such as update-initramfs for each kernel, to run
+concurrently.
+Default: 1""")
+
     c.add_argument('--hostname',
                    dest='chroot_hostname',
                    metavar='<HOSTNAME>',
@@ -313,12 +442,22 @@ Default: chroot""")
 
     f.add_argument('--compression',
                    dest='fscomp_compression',
+                   nargs='+',
                    metavar='<COMP>',
                    choices=['mkfs', 'squashfs','tar','none'],
                    help="""\
-Select compression type. Choices: %(choices)s.
+Select list of compression types, created concurrently.
+Choices: %(choices)s.
 Default: none""")
 
+    f.add_argument('--compression-cpus',
+                   dest='fscomp_cpus',
+                   type=int,
+                   metavar='<CPUS>',
+                   help="""\
+Number of cpus to share between the compression types.
+Default: 0 (all)""")
+
     f.add_argument('--wrap',
                    dest='fscomp_wrap',
                    nargs='+',
@@ -330,11 +469,43 @@ Default: none""")
     f.add_argument('--squashfs-compressor',
                    dest='fscomp_squashfs_compressor',
                    metavar='<COMPRESSOR>',
-                   choices=['gzip', 'lzo', 'xz'],
+                   choices=['gzip', 'lzo', 'lz4', 'xz', 'zstd'],
                    help="""\
 Squashfs compression type. Choices: %(choices)s.
 Default: gzip""")
 
+    f.add_argument('--squashfs-level',
+                   dest='fscomp_squashfs_level',
+                   type=int,
+                   metavar='<LEVEL>',
+                   help="""\
+Squashfs compression level, 1-9 for gzip and lzo, 1-22 for zstd, any for
+lz4 high compression mode.
+Default: 0 (compressor default)""")
+
+    f.add_argument('--squashfs-block',
+                   dest='fscomp_squashfs_block',
+                   type=int,
+                   metavar='<BYTES>',
+                   help="""\
+Squashfs block size in bytes.
+Default: 0 (mksquashfs default)""")
+
+    f.add_argument('--squashfs-processors',
+                   dest='fscomp_squashfs_processors',
+                   type=int,
+                   metavar='<NUM>',
+                   help="""\
+Number of processors mksquashfs may use.
+Default: 0 (all)""")
+
+    f.add_argument('--squashfs-mem',
+                   dest='fscomp_squashfs_mem',
+                   metavar='<SIZE>',
+                   help="""\
+Memory limit of mksquashfs (eg. 512M, 2G).
+Default: '' (mksquashfs default)""")
+
     f.add_argument('--squashfs-file',
                    dest='fscomp_squashfs_file',
                    metavar='<FILE>',
@@ -365,6 +536,15 @@ Default: ''""")
 Mkfs filesystem type. Choices: %(choices)s.
 Default: ext2""")
 
+    f.add_argument('--mkfs-method',
+                   dest='fscomp_mkfs_method',
+                   metavar='<METHOD>',
+                   choices=['populate', 'mount'],
+                   help="""\
+Mkfs method, populate a filesystem sized to fit with mkfs -d, or copy into
+a loop mounted filesystem and shrink it. Choices: %(choices)s.
+Default: populate""")
+
     f.add_argument('--mkfs-size',
                    dest='fscomp_mkfs_size',
                    type=int,
@@ -400,6 +580,60 @@ Default: ''""")
 ISO filename.
 Default: ''""")
 
+    f.add_argument('--dedup',
+                   dest='fscomp_dedup_enable',
+                   action='store_true',
+                   help="""\
+Hardlink identical files of the chroot before compressing it.""")
+
+    f.add_argument('--dedup-jobs',
+                   dest='fscomp_dedup_jobs',
+                   type=int,
+                   metavar='<JOBS>',
+                   help="""\
+Number of files to hash at once for deduplication.
+Default: 0 (number of cpus)""")
+
+    f.add_argument('--tune',
+                   dest='fscomp_tune_enable',
+                   action='store_true',
+                   help="""\
+Benchmark the candidate compressor settings on a sample of the chroot,
+and use and store the one which best meets the tune goal.""")
+
+    f.add_argument('--tune-goal',
+                   dest='fscomp_tune_goal',
+                   metavar='<GOAL>',
+                   choices=['size', 'speed'],
+                   help="""\
+Tune for the smallest image compressed within the limit in minutes (size),
+or the fastest decompression of an image within the limit in MB (speed).
+Choices: %(choices)s.
+Default: size""")
+
+    f.add_argument('--tune-limit',
+                   dest='fscomp_tune_limit',
+                   type=int,
+                   metavar='<LIMIT>',
+                   help="""\
+Limit of the tune goal, in minutes or MB.
+Default: 0 (no limit)""")
+
+    f.add_argument('--tune-sample',
+                   dest='fscomp_tune_sample',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Approximate size in MB of the sample of the chroot to tune with.
+Default: 256""")
+
+    f.add_argument('--tune-file',
+                   dest='fscomp_tune_file',
+                   metavar='<FILE>',
+                   help="""\
+File to store the tuned compressor settings in, used by later builds.
+Default: <DIR>/fscomp.tune""")
+
     f.add_argument('--fscomp-quiet',
                    action='store_true',
                    help="""\
@@ -493,6 +727,14 @@ def get_config_file():
     return args.config
 
 
+def get_config_spec():
+    """Return the configuration spec file, of the source tree if run from
+    it."""
+    if os.path.isfile('data/fll.conf.spec'):
+        return file(os.path.realpath('data/fll.conf.spec'))
+    return file('/usr/share/fll/data/fll.conf.spec')
+
+
 def get_dump_file():
     """Parse sys.argv for --dump argument and return its value."""
     p = argparse.ArgumentParser(add_help=False)
@@ -514,24 +756,27 @@ class Config(object):
     """
     A class for abstracting the fll configuration file.
     """
+    # fscomp settings which may be stored by tuning
+    tunables = {'squashfs': ('compressor', 'level', 'block'),
+                'tar': ('compressor',)}
+
     def __init__(self):
         self.config_file = get_config_file()
         if self.config_file is None:
             self.config_file = file(os.devnull)
 
-        if os.path.isfile('data/fll.conf.spec'):
-            self.config_spec = file(os.path.realpath('data/fll.conf.spec'))
-        else:
-            self.config_spec = file('/usr/share/fll/data/fll.conf.spec')
+        self.config_spec = get_config_spec()
 
         self.config = ConfigObj(self.config_file, configspec=self.config_spec,
                                 interpolation='template')
 
         self._process_cmdline()
+        self.configured = self._configured_tunables()
         self._validate_config()
         self._debug_configobj()
         self._propogate_modes()
         self._config_defaults()
+        self._tune_settings()
         self._set_environment()
 
     def _validate_config(self):
@@ -624,6 +869,52 @@ class Config(object):
 
         self.config['dir'] = os.path.realpath(self.config['dir'])
 
+    def _configured_tunables(self):
+        """Return the (section, key) of the tunable fscomp settings given in
+        the configuration file or on the command line. Validation fills in
+        the defaults of the others, so this must be called before it."""
+        fscomp = self.config.get('fscomp', {})
+        return set([(section, key)
+                    for section, keys in self.tunables.iteritems()
+                    for key in keys if key in fscomp.get(section, {})])
+
+    def _tune_settings(self):
+        """Merge the compressor settings stored by fscomp tuning, only
+        over those left to their defaults by the configuration file and the
+        command line."""
+        tune = self.config['fscomp']['tune']
+        if not tune['file']:
+            tune['file'] = os.path.join(self.config['dir'], 'fscomp.tune')
+        if not os.path.isfile(tune['file']):
+            return
+
+        try:
+            tuned = ConfigObj(tune['file'])
+        except ConfigObjError, e:
+            raise ConfigError('failed to read tune file %s: %s' %
+                              (tune['file'], e))
+
+        # tuned values are checked against the spec, as those of the
+        # config file are
+        validator = Validator()
+        for section, keys in self.tunables.iteritems():
+            if section not in tuned:
+                continue
+            config = self.config['fscomp'][section]
+            for key, value in tuned[section].iteritems():
+                if key not in keys:
+                    continue
+                if (section, key) in self.configured:
+                    continue
+                try:
+                    config[key] = validator.check(config.configspec[key],
+                                                  value)
+                except ValidateError, e:
+                    raise ConfigError('invalid %s %s in tune file %s: %s' %
+                                      (section, key, tune['file'], e))
+                print 'FSCOMP TUNE %s %s=%s from %s' % \
+                    (section, key, value, tune['file'])
+
     def _propogate_modes(self):
         """Propogate global verbosity mode to config sections. Do not
         propogate to sections which have independently configured verbosity
@@ -10,6 +10,7 @@ License:   GPL-2
 """
 
 import os
+import fll.trace
 
 class DistroError(Exception):
     pass
@@ -32,6 +33,7 @@ class Distro(object):
         self.chroot = chroot
         self.config = config
 
+    @fll.trace.traced('distro')
     def init(self):
         self.password()
 
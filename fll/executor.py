@@ -0,0 +1,121 @@
+"""
+This is the fll.executor module, it executes batches of commands, either
+directly or as the server of fll.chroot.ChrootExecutor. The server is a
+fresh interpreter which imports no more than this module needs, so that
+the commands it forks are forked from a small process rather than from
+the build process.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+import cPickle
+import fcntl
+import fll.misc
+import fll.trace
+import os
+import subprocess
+import threading
+import time
+
+
+def execute(cmd, pipe=False, quiet=False, stderr=False, preexec_fn=None,
+            env=None):
+    """Execute cmd. Returns a (returncode, output, usage) tuple, returncode
+    is None if cmd could not be executed and output is then the reason why.
+    usage is as per fll.misc.wait(). If stderr is True, stderr is captured
+    with stdout when pipe is True."""
+    devnull = output = None
+
+    try:
+        if pipe:
+            proc = subprocess.Popen(cmd, preexec_fn=preexec_fn, cwd='/',
+                                    env=env, stdout=subprocess.PIPE,
+                                    stderr=stderr and subprocess.STDOUT
+                                           or None)
+            output = proc.stdout.read()
+            proc.stdout.close()
+        elif quiet:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            proc = subprocess.Popen(cmd, preexec_fn=preexec_fn, cwd='/',
+                                    env=env, stdout=devnull)
+        else:
+            proc = subprocess.Popen(cmd, preexec_fn=preexec_fn, cwd='/',
+                                    env=env)
+        usage = fll.misc.wait(proc)
+    except OSError, e:
+        return None, str(e), dict()
+    finally:
+        if devnull:
+            os.close(devnull)
+
+    return proc.returncode, output, usage
+
+
+def execute_batch(batch, jobs=1, preexec_fn=None, env=None):
+    """Execute a batch of (cmd, pipe, quiet, stderr) commands. If jobs is
+    1 they are executed in order, stopping at the first which fails.
+    Otherwise all are executed, up to jobs at a time. Returns a list of
+    (returncode, output, usage, begin, end) tuples, as per execute() and
+    the times each command began and ended."""
+    def run(args):
+        cmd, pipe, quiet, stderr = args
+        begin = time.time()
+        returncode, output, usage = execute(cmd, pipe=pipe, quiet=quiet,
+                                            stderr=stderr,
+                                            preexec_fn=preexec_fn, env=env)
+        return returncode, output, usage, begin, time.time()
+
+    if jobs > 1 and len(batch) > 1:
+        results = [None] * len(batch)
+        pending = list(enumerate(batch))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    i, args = pending.pop(0)
+                results[i] = run(args)
+
+        threads = [threading.Thread(target=worker)
+                   for n in range(min(jobs, len(batch)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    results = list()
+    for args in batch:
+        results.append(run(args))
+        if results[-1][0] != 0:
+            break
+    return results
+
+
+def serve(rootdir, req, rep):
+    """Chroot to rootdir, then execute the batches of commands read from
+    the req pipe and write their results to the rep pipe until req is
+    closed. Each request is a (batch, jobs, env, trace) tuple, trace is
+    whether the usage of the commands is sampled as when tracing."""
+    for fd in (req, rep):
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    fll.misc.restore_sigpipe()
+    os.chroot(rootdir)
+    os.chdir('/')
+
+    req = os.fdopen(req, 'rb')
+    rep = os.fdopen(rep, 'wb')
+    while True:
+        try:
+            batch, jobs, env, trace = cPickle.load(req)
+        except EOFError:
+            return
+        fll.trace.enable(trace)
+        results = execute_batch(batch, jobs=jobs, env=env)
+        cPickle.dump(results, rep, 2)
+        rep.flush()
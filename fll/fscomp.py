@@ -8,9 +8,22 @@ Copyright: Copyright (C) 2013-2014 Niall Walsh <niallwalsh@celtux.org>
 License:   GPL-2
 """
 
+from configobj import ConfigObj, ConfigObjError
+from multiprocessing.pool import ThreadPool
+
+import errno
+import fcntl
+import fll.manifest
 import fll.misc
+import fll.trace
+import hashlib
+import multiprocessing
 import os
+import pipes
 import shutil
+import stat
+import sys
+import threading
 import time
 
 class FsCompError(Exception):
@@ -19,6 +32,12 @@ class FsCompError(Exception):
 
 class FsComp(object):
     taropt = dict( gz='-z', bz='-j', xz='-J', pz='-Ipixz' )
+    # single threaded compression programs of tar, for tuning
+    tarprog = dict( gz='gzip', bz='bzip2', xz='xz -T1', pz='pixz -p 1' )
+    # xz BCJ filters for the executable code of each architecture
+    bcj = dict( amd64='x86', i386='x86', armel='arm', armhf='armthumb',
+                arm64='arm64', powerpc='powerpc', ia64='ia64',
+                sparc='sparc', sparc64='sparc' )
     excludes = [ 'etc/.*lock', 'etc/*-', 'etc/adjtime', 'etc/apt/*~',
                  'etc/blkid.tab', 'etc/console-setup/*.gz', 'etc/localtime',
                  'etc/lvm/archive', 'etc/lvm/backup', 'etc/lvm/cache',
@@ -31,83 +50,640 @@ class FsComp(object):
                  'var/lib/alsa/asound.state', 'var/lib/apt/extended_states',
                  'var/lib/apt/lists/*_dists_*', 'var/lib/dbus/machine-id',
                  'var/lib/dpkg/*-old', 'var/run/*' ]
+    # work files and directories of fscomp in the chroot, always excluded
+    workdirs = [ 'tmp/fll-*' ]
+    workpaths = [ 'tmp/fll-excludes', 'tmp/fll-iso', 'tmp/fll-manifest-tar',
+                  'tmp/fll-manifest-mkfs', 'tmp/fll-mkfs', 'tmp/fll-stream',
+                  'tmp/fll-tune' ]
+    # the staging directory of the iso wrapper
+    isodir = '/tmp/fll-iso'
+    backends = dict( squashfs='squash', tar='tar', mkfs='mkfs' )
+    # typical size of a compressed chroot relative to its installed size,
+    # of each compressor, to estimate image sizes by if not tuned
+    ratios = dict( squashfs=dict( gzip=0.40, lzo=0.47, lz4=0.52, xz=0.31,
+                                  zstd=0.34 ),
+                   tar=dict( gz=0.38, bz=0.34, xz=0.28, pz=0.28 ) )
     def __init__(self, chroot=None,config={}):
         self.chroot=chroot
         self.config=config
         self.output=list()
+        self.artifacts=dict()
+        self.binds=list()
+        self.manifests=dict()
+        self.mkfsplan=None
+        self.targets=dict()
+        self.lock=threading.Lock()
         self.depends=[]
         self.ts=''
-        if (self.config['compression'] == 'squashfs'):
+        self.compression = [ c for c in self.config['compression']
+                             if c != 'none' ]
+        for comp in self.compression:
+            if (comp not in self.backends):
+                raise FsCompError('unknown compression: %s' % comp)
+        if ('squashfs' in self.compression):
             self.depends.append('squashfs-tools')
-        elif (self.config['compression'] == 'mkfs'):
-            self.depends.append('rsync')
+        if ('mkfs' in self.compression):
+            if (self.config['mkfs']['method'] == 'mount'):
+                self.depends.append('rsync')
+            else:
+                self.depends.append('e2fsprogs')
         if (('wrap' in self.config) and ('iso' in self.config['wrap'])):
             # ,'grub-efi-amd64-bin','grub-efi-ia32-bin'
             self.depends.extend(['grub-pc','xorriso'])
 
     def compress(self):
-        """create whatever is set for compression and wrap it"""
+        """create whatever is set for compression and wrap it. The
+        backends, and the staging of the wrappers, run concurrently."""
         # create the stamp file to identify the fs
         self.stamp()
-        if (self.config['compression'] == 'squashfs'):
-            self.squash()
-        elif (self.config['compression'] == 'tar'):
-            self.tar()
-        elif (self.config['compression'] == 'mkfs'):
-            self.mkfs()
-        self.wrap()
-
-    def squash(self):
-        """create a squashfs file of the chroot"""
+        if (self.config['dedup']['enable']):
+            self.dedup()
+        if (self.config['tune']['enable']):
+            for comp in self.compression:
+                if (comp in [ 'squashfs', 'tar' ]):
+                    self.tune(comp)
+        cpus = self.budget()
+        tasks = [ (getattr(self, self.backends[comp]), (cpus[comp],))
+                  for comp in self.compression ]
+        if (len(self.compression) > 0):
+            tasks.append((self.prewrap, ()))
+        try:
+            # resolve the artifacts of all backends, and bind their output
+            # directories, before any backend reads the chroot so that
+            # squashfs excludes them all
+            for comp in self.compression:
+                self.target(comp)
+            if ('mkfs' in self.compression and
+                self.config['mkfs']['method'] == 'populate'):
+                self.mkfsplan = self.mkfsprepare()
+            outputs = self.concurrently(tasks)
+            self.output.extend(outputs[:len(self.compression)])
+            self.wrap()
+        finally:
+            self.mkfsclean()
+            self.unbind()
+
+    def concurrently(self, tasks):
+        """run each (function, args) of tasks in a thread and return their
+        results. The first exception raised by a task is raised once all of
+        them are done."""
+        if (len(tasks) == 1):
+            func, args = tasks[0]
+            return([ func(*args) ])
+        results = [ None ] * len(tasks)
+        errors = list()
+
+        def run(i, func, args):
+            try:
+                results[i] = func(*args)
+            except:
+                errors.append(sys.exc_info())
+
+        threads = [ threading.Thread(target=run, args=(i, f, a))
+                    for i, (f, a) in enumerate(tasks) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if (len(errors) > 0):
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return(results)
+
+    def budget(self):
+        """share the cpus between the backends. mkfs and tar with a single
+        threaded compressor take one, the others share the rest."""
+        cpus = self.config['cpus'] or multiprocessing.cpu_count()
+        single = [ c for c in self.compression
+                   if (c == 'mkfs' or (c == 'tar' and
+                       self.config['tar']['compressor'] in [ 'gz', 'bz' ])) ]
+        multi = [ c for c in self.compression if c not in single ]
+        share = max(1, (cpus - len(single)) / max(1, len(multi)))
+        return(dict([ (c, c in single and 1 or share)
+                      for c in self.compression ]))
+
+    def budgeted(self):
+        """whether backends are limited to their share of the cpus"""
+        return(len(self.compression) > 1 or self.config['cpus'] > 0)
+
+    @fll.trace.traced('fscomp squashfs')
+    def squash(self, cpus=0):
+        """create a squashfs file of the chroot, with cpus processors if
+        the backends are budgeted"""
         config = self.config['squashfs']
-        output = None
-        if (len(config['file']) > 0):
-            filename = config['file']
-            output = filename
-        else:
-            filename = 'tmp/squash'
-        cmd = [ 'mksquashfs', '.', filename, '-comp', config['compressor'] ]
-        if (config['compressor'] == 'xz'):
-            cmd.extend('-Xbcj', 'x86')
-        cmd.extend(['-wildcards', '-ef', self.excludesfile(config,filename)])
+        filename, output = self.target('squashfs')
+        cmd = [ 'mksquashfs', '.', filename ]
+        cmd.extend(self.squashopts(config['compressor'], config['level'],
+                                   config['block']))
+        if (config['processors'] > 0):
+            cmd.extend(['-processors', '%i' % config['processors']])
+        elif (self.budgeted()):
+            cmd.extend(['-processors', '%i' % cpus])
+        if (len(config['mem']) > 0):
+            cmd.extend(['-mem', config['mem']])
+        cmd.extend(['-one-file-system',
+                    '-ef', self.excludesfile(config)])
         self.chroot.cmd(cmd)
-        if (output != None):
-            shutil.move(self.chroot.chroot_path(filename),output)
-            self.output.append(output)
-        else:
-            self.output.append(filename)
+        return(self.artifact(filename, output))
 
-    def tar(self):
-        """create a tar of the chroot"""
-        config = self.config['tar']
-        output = None
+    def squashopts(self, compressor, level=0, block=0):
+        """mksquashfs options for compressor at level (0 is the compressor
+        default) and block size in bytes (0 is the mksquashfs default)"""
+        opts = [ '-comp', compressor ]
+        if (compressor == 'xz'):
+            arch = self.chroot.architecture
+            if (arch in self.bcj):
+                opts.extend(['-Xbcj', self.bcj[arch]])
+        elif (level > 0):
+            if (compressor in [ 'gzip', 'lzo', 'zstd' ]):
+                opts.extend(['-Xcompression-level', '%i' % level])
+            elif (compressor == 'lz4'):
+                opts.append('-Xhc')
+        if (block > 0):
+            opts.extend(['-b', '%i' % block])
+        return(opts)
+
+    @fll.trace.traced('fscomp dedup')
+    def dedup(self):
+        """hardlink identical regular files of the chroot which have the
+        same ownership and mode, no extended attributes, are not excluded
+        and are within the included paths. Candidates are found by size,
+        then a hash of their start, then a hash of their content."""
+        config = self.config['dedup']
+        if (len(self.compression) == 0):
+            print 'FSCOMP DEDUP skipped, nothing to compress'
+            return
+        comp = self.compression[0]
+        manifest = self.manifest(self.config[comp])
+        include = fll.manifest.Matcher(config['include'])
+        groups = dict()
+        for e in manifest.files():
+            if (e.size >= config['minsize'] and include(e.path)):
+                key = (e.size, e.uid, e.gid, e.mode)
+                groups.setdefault(key, list()).append(e)
+        groups = [ g for g in groups.values() if len(g) > 1 ]
+
+        pool = ThreadPool(config['jobs'] or multiprocessing.cpu_count())
+        try:
+            groups = self.deduphash(pool, groups, self.fasthash)
+            # the start of a small file is all of it
+            small = [ g for g in groups if g[0].size <= self.fastsize ]
+            groups = [ g for g in groups if g[0].size > self.fastsize ]
+            groups = small + self.deduphash(pool, groups, self.fullhash)
+        finally:
+            pool.close()
+            pool.join()
+
+        rootdir = self.chroot.rootdir
+        changed = list()
+        saved = dict(files=0, bytes=0, inodes=0)
+        for group in groups:
+            group.sort(key=lambda e: e.path)
+            group = [ e for e in group
+                      if (len(fll.misc.listxattr(
+                                  os.path.join(rootdir, e.path))) == 0) ]
+            if (len(group) < 2):
+                continue
+            target = group[0]
+            replaced = dict()
+            for e in group[1:]:
+                if (e.ino == target.ino):
+                    continue
+                path = os.path.join(rootdir, e.path)
+                tmp = path + '.fll-dedup'
+                os.link(os.path.join(rootdir, target.path), tmp)
+                os.rename(tmp, path)
+                changed.append(e.path)
+                saved['files'] += 1
+                replaced[e.ino] = replaced.get(e.ino, 0) + 1
+                # the inode is freed with the last of its links
+                if (replaced[e.ino] == e.nlink):
+                    saved['bytes'] += e.blocks * 512
+                    saved['inodes'] += 1
+            if (len(replaced) > 0):
+                changed.append(target.path)
+
+        try:
+            manifest.refresh(changed)
+        except fll.manifest.ManifestError, e:
+            raise FsCompError(e)
+        # other manifests are stale, they are walked again when needed
+        for key in self.manifests.keys():
+            if (self.manifests[key] is not manifest):
+                del self.manifests[key]
+        print 'FSCOMP DEDUP linked %i files, saved %iMB in %i inodes' % \
+              (saved['files'], saved['bytes']/2**20,
+               saved['inodes'])
+
+    # bytes of the start of a file hashed to find candidates to dedup
+    fastsize = 2**16
+
+    def deduphash(self, pool, groups, hashfunc):
+        """split groups of manifest entries by the hashfunc of their files,
+        hashing one file of each inode on pool. Returns the groups of more
+        than one inode."""
+        rootdir = self.chroot.rootdir
+        inodes = dict()
+        for i, group in enumerate(groups):
+            for e in group:
+                inodes.setdefault(e.ino, (i, e.path))
+        paths = [ os.path.join(rootdir, path) for i, path in inodes.values() ]
+        hashes = dict(zip(inodes.keys(), pool.map(hashfunc, paths, 64)))
+        split = dict()
+        for i, group in enumerate(groups):
+            for e in group:
+                if (hashes[e.ino] is not None):
+                    split.setdefault((i, hashes[e.ino]), list()).append(e)
+        return([ g for g in split.values()
+                 if len(set([ e.ino for e in g ])) > 1 ])
+
+    def fasthash(self, path):
+        """return a hash of the start of a file, or None if unreadable"""
+        try:
+            with open(path, 'rb') as fh:
+                return(hashlib.sha1(fh.read(self.fastsize)).digest())
+        except IOError:
+            return(None)
+
+    def fullhash(self, path):
+        """return a hash of a file, or None if unreadable"""
+        h = hashlib.sha256()
+        try:
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(2**20), ''):
+                    h.update(chunk)
+        except IOError:
+            return(None)
+        return(h.digest())
+
+    @fll.trace.traced('fscomp tune')
+    def tune(self, comp):
+        """benchmark the candidate settings of the compressor of comp on a
+        sample of the chroot, use the one which best meets the goal and
+        store it in the tune file for the builds which follow"""
+        config = self.config['tune']
+        candidates = self.candidates(comp)
+        workdir = '/tmp/fll-tune'
+        sample = os.path.join(workdir, 'sample')
+        if (os.path.exists(self.chroot.chroot_path(workdir))):
+            shutil.rmtree(self.chroot.chroot_path(workdir))
+        os.makedirs(self.chroot.chroot_path(sample))
+        try:
+            total, size, count = self.sample(comp, sample,
+                                             config['sample']*2**20)
+            print 'FSCOMP TUNE sample %iMB of %iMB in %i files' % \
+                  (size/2**20, total/2**20, count)
+            if (size == 0):
+                print 'FSCOMP TUNE skipped, nothing to sample'
+                return
+            jobs = config['jobs'] or multiprocessing.cpu_count()
+            jobs = min(jobs, len(candidates))
+            # each job holds a compressed and uncompressed copy at most
+            self.chroot.require_space(2 * jobs * size)
+            cmds = list()
+            for i, (name, setting) in enumerate(candidates):
+                out = os.path.join(workdir, 'out.%i' % i)
+                tmp = os.path.join(workdir, 'tmp.%i' % i)
+                if (comp == 'squashfs'):
+                    pack = [ 'mksquashfs', sample, out, '-noappend',
+                             '-no-progress', '-processors', '1' ]
+                    pack.extend(self.squashopts(setting['compressor'],
+                                                setting['level'],
+                                                setting['block']))
+                    unpack = [ 'unsquashfs', '-n', '-p', '1', '-d', tmp, out ]
+                else:
+                    prog = self.tarprog[setting['compressor']]
+                    pack = [ 'tar', '-c', '-I', prog, '-f', out,
+                             '-C', sample, '.' ]
+                    unpack = [ 'tar', '-x', '-O', '-I', prog, '-f', out ]
+                cmds.append(['sh', '-c', self.tunescript %
+                             (' '.join([pipes.quote(a) for a in pack]),
+                              ' '.join([pipes.quote(a) for a in unpack]),
+                              out, tmp, out)])
+            for name, setting in candidates:
+                print 'FSCOMP TUNE %s' % name
+            outputs = self.chroot.cmds(cmds, pipe=True, silent=True,
+                                       jobs=jobs)
+        finally:
+            shutil.rmtree(self.chroot.chroot_path(workdir))
+
+        results = list()
+        for (name, setting), output in zip(candidates, outputs):
+            fields = output.split()
+            if (len(fields) != 3):
+                print 'FSCOMP TUNE %-16s failed' % name
+                continue
+            ctime, dtime, csize = [ max(1, int(f)) for f in fields ]
+            if (comp == 'squashfs'):
+                cpus = self.config['squashfs']['processors']
+            else:
+                cpus = setting['compressor'] == 'pz' and 0 or 1
+            cpus = cpus or multiprocessing.cpu_count()
+            r = dict(name=name, setting=setting,
+                     ratio=float(csize) / size,
+                     cspeed=size * 1e9 / ctime,
+                     dspeed=size * 1e9 / dtime)
+            r['size'] = total * r['ratio']
+            r['time'] = total / r['cspeed'] / cpus
+            results.append(r)
+            print 'FSCOMP TUNE %-16s ratio %.3f compress %.1fMB/s ' \
+                  'decompress %.1fMB/s image %iMB in %.1fmin' % \
+                  (name, r['ratio'], r['cspeed']/2**20, r['dspeed']/2**20,
+                   r['size']/2**20, r['time']/60)
+        if (len(results) == 0):
+            raise FsCompError('no tune candidate succeeded')
+
+        best = self.choose(results, config['goal'], config['limit'])
+        self.config[comp].update(best['setting'])
         if (len(config['file']) > 0):
-            filename = config['file']
-            output = filename
-        else:
-            filename = 'tmp/rootfs.tar'
-            if ('compressor' in config):
-                filename = '%s.%s' % (filename, config['compressor'])
-                output = '%s.%s' % (output, config['compressor'])
-        self.chroot.cmd([ 'tar',
-                          '-c', "%s" % self.taropt[config['compressor']],
-                          '-f', filename,
-                          '-X', self.excludesfile(config,filename), '.' ])
-        if (output != None):
-            shutil.move(self.chroot.chroot_path(filename),output)
-            self.output.append(output)
+            tuned = ConfigObj(config['file'])
+            tuned[comp] = best['setting']
+            if ('result' not in tuned):
+                tuned['result'] = dict()
+            tuned['result'][comp] = dict(setting=best['name'],
+                                         ratio='%.4f' % best['ratio'])
+            tuned.write()
+        print 'FSCOMP TUNE chose %s %s' % (comp, best['name'])
+
+    # time the compression and decompression of a candidate and report
+    # them with the compressed size, on failure report failed
+    tunescript = """t0=$(date +%%s%%N)
+%s >/dev/null 2>&1 || { echo failed; exit 0; }
+t1=$(date +%%s%%N)
+%s >/dev/null 2>&1 || { echo failed; exit 0; }
+t2=$(date +%%s%%N)
+echo $((t1-t0)) $((t2-t1)) $(stat -c %%s %s)
+rm -rf %s %s"""
+
+    def candidates(self, comp):
+        """return a list of (name, setting) of the tune candidates of comp.
+        squashfs candidates are compressor[:level[:block]], block may have
+        a K or M suffix. tar candidates are a compressor."""
+        choices = dict(squashfs=[ 'gzip', 'lzo', 'lz4', 'xz', 'zstd' ],
+                       tar=self.taropt.keys())
+        candidates = list()
+        for name in self.config['tune'][comp]:
+            fields = name.split(':')
+            if (fields[0] not in choices[comp] or
+                (comp == 'tar' and len(fields) > 1) or len(fields) > 3):
+                raise FsCompError('invalid %s tune candidate: %s' %
+                                  (comp, name))
+            setting = dict(compressor=fields[0])
+            if (comp == 'squashfs'):
+                fields.extend(['0', '0'])
+                try:
+                    setting['level'] = int(fields[1] or 0)
+                    block = fields[2].upper()
+                    scale = dict(K=2**10, M=2**20).get(block[-1:], 1)
+                    setting['block'] = int(block.rstrip('KM') or 0) * scale
+                except ValueError:
+                    raise FsCompError('invalid %s tune candidate: %s' %
+                                      (comp, name))
+            candidates.append((name, setting))
+        if (len(candidates) == 0):
+            raise FsCompError('no %s tune candidates' % comp)
+        return(candidates)
+
+    def sample(self, comp, sample, size):
+        """hardlink about size bytes of the files of the chroot, less the
+        excludes, into sample. Files are chosen at even intervals of bytes,
+        so each kind of content is sampled in proportion to its share of
+        the chroot. Returns total bytes, sample bytes and sample files."""
+        manifest = self.manifest(self.config[comp])
+        rootdir = self.chroot.rootdir
+        total = manifest.size
+
+        # take the files which start in one of 64 windows of size/64 bytes,
+        # spread evenly over the total bytes
+        window = max(1, size / 64)
+        step = max(1.0, float(total) / size) * window
+        pos = 0
+        taken = 0
+        count = 0
+        for e in manifest.files():
+            if (pos % step < window):
+                src = os.path.join(rootdir, e.path)
+                dst = self.chroot.chroot_path(os.path.join(sample, e.path))
+                if (not os.path.isdir(os.path.dirname(dst))):
+                    os.makedirs(os.path.dirname(dst))
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+                taken += e.size
+                count += 1
+            pos += e.size
+        return(total, taken, count)
+
+    def choose(self, results, goal, limit):
+        """choose the smallest image compressed within limit minutes if
+        goal is size, or the fastest decompression of an image within limit
+        MB if goal is speed. A limit of 0 is no limit. If nothing is within
+        the limit, the one closest to it is chosen."""
+        if (goal == 'size'):
+            within = [ r for r in results
+                       if limit == 0 or r['time'] <= limit*60 ]
+            order = lambda r: (r['ratio'], -r['dspeed'])
+            closest = lambda r: r['time']
         else:
-            self.output.append(filename)
+            within = [ r for r in results
+                       if limit == 0 or r['size'] <= limit*2**20 ]
+            order = lambda r: (-r['dspeed'], r['ratio'])
+            closest = lambda r: r['size']
+        if (len(within) == 0):
+            print 'FSCOMP TUNE nothing within limit of %i %s' % \
+                  (limit, goal == 'size' and 'minutes' or 'MB')
+            return(min(results, key=closest))
+        return(min(within, key=order))
+
+    def estimate(self, size):
+        """return a list of (compression, size, basis) of the estimated size
+        in bytes of each image of a chroot of size bytes. The ratio stored
+        by tuning is used if it is of the configured compressor, otherwise
+        that of the ratios table. mkfs images are scaled by factor."""
+        tuned = dict()
+        tunefile = self.config['tune']['file']
+        if (len(tunefile) > 0 and os.path.isfile(tunefile)):
+            try:
+                tuned = ConfigObj(tunefile)
+            except ConfigObjError, e:
+                raise FsCompError('failed to read tune file %s: %s' %
+                                  (tunefile, e))
+        estimates = list()
+        for comp in self.compression:
+            if (comp == 'mkfs'):
+                factor = self.config['mkfs']['factor']
+                estimates.append((comp, size * factor / 100,
+                                  'factor %i%%' % factor))
+                continue
+            compressor = self.config[comp]['compressor']
+            try:
+                if (tuned[comp]['compressor'] != compressor):
+                    raise KeyError(comp)
+                result = tuned['result'][comp]
+                estimates.append((comp, int(size * float(result['ratio'])),
+                                  'tuned %s' % result['setting']))
+            except (KeyError, TypeError, ValueError):
+                ratio = self.ratios[comp][compressor]
+                estimates.append((comp, int(size * ratio),
+                                  'table %s' % compressor))
+        return(estimates)
+
+    @fll.trace.traced('fscomp tar')
+    def tar(self, cpus=0):
+        """create a tar of the chroot, with a compressor of cpus threads if
+        the backends are budgeted"""
+        config = self.config['tar']
+        filename, output = self.target('tar')
+        compressor = [ self.taropt[config['compressor']] ]
+        if (self.budgeted() and config['compressor'] in self.tarthreads):
+            compressor = [ '-I', self.tarthreads[config['compressor']] % cpus ]
+        cmd = [ 'tar', '-c' ] + compressor
+        cmd.extend([ '-f', self.fifo, '--null', '--no-recursion',
+                     '-T', self.manifestfile(config, 'tar') ])
+        digests = self.stream(cmd, self.chroot.chroot_path(filename))
+        return(self.artifact(filename, output, digests))
+
+    # multi threaded compression programs of tar, for a number of threads
+    tarthreads = dict( xz='xz -T%i', pz='pixz -p %i' )
 
-    def mkfs(self):
+    @fll.trace.traced('fscomp mkfs')
+    def mkfs(self, cpus=1):
         """create a filesystem image of the chroot"""
-        config = self.config['mkfs']
-        output = None
-        if (len(config['file']) > 0):
-            filename = config['file']
-            output = filename
+        if (self.config['mkfs']['method'] == 'mount'):
+            return(self.mkfsmount())
         else:
-            filename = 'tmp/rootfs'
+            return(self.mkfspopulate())
+
+    def mkfspopulate(self):
+        """create a filesystem image of the chroot sized to fit and
+        populated by mkfs -d from a hardlink farm of the chroot, less the
+        excludes"""
+        config = self.config['mkfs']
+        filename, output = self.target('mkfs')
+        if (self.mkfsplan == None):
+            self.mkfsplan = self.mkfsprepare()
+        blocks, inodes = self.mkfsplan
+        # the farm is removed by compress() once no backend reads the
+        # chroot, unlinking it changes the files of the chroot too
+        self.chroot.cmd([ 'mkfs', '-t', config['type'], '-q',
+                          '-b', '4096', '-m', '0', '-N', '%i' % inodes,
+                          '-E', 'root_owner=0:0', '-d', self.farm,
+                          filename, '%ik' % (blocks*4) ])
+        return(self.artifact(filename, output))
+
+    # the hardlink farm which mkfs -d populates an image from
+    farm = '/tmp/fll-mkfs'
+
+    @fll.trace.traced('fscomp mkfs farm')
+    def mkfsprepare(self):
+        """hardlink the farm and size the filesystem image of mkfs -d.
+        This changes the link counts and times of the files of the chroot
+        and may move the chroot to make space, so it is done before other
+        backends read the chroot. Returns the size in 4k blocks and the
+        inodes of the filesystem."""
+        config = self.config['mkfs']
+        self.mkfsclean()
+        usage = self.mkfsfarm(self.chroot.chroot_path(self.farm),
+                              self.manifest(config))
+        blocks, inodes = self.mkfssize(usage, config)
+        print 'FSCOMP MKFS %i files %iMB in %i inodes %iMB' % \
+              (usage['inodes'], usage['blocks']*4096/2**20, inodes,
+               blocks*4096/2**20)
+        self.chroot.require_space(blocks*4096)
+        return(blocks, inodes)
+
+    def mkfsclean(self):
+        """remove the hardlink farm"""
+        if (os.path.exists(self.chroot.chroot_path(self.farm))):
+            shutil.rmtree(self.chroot.chroot_path(self.farm))
+
+    def mkfsfarm(self, farm, manifest):
+        """hardlink the entries of manifest into farm. Directories,
+        symlinks and device nodes are recreated, their ownership, mode and
+        times kept. Returns the usage of the farm in 4k blocks of data,
+        inodes, directories and bytes of directory entries."""
+        rootdir = self.chroot.rootdir
+        usage = dict(blocks=0, inodes=0, dirs=0, dirents=0)
+        seen = set()
+        made = list()
+        for e in manifest.entries:
+            if (e.type == 's'):
+                continue
+            s = os.path.join(rootdir, e.path)
+            d = os.path.join(farm, e.path)
+            if (len(e.path) > 0):
+                # a directory entry is 8 bytes and the name 4 byte aligned
+                name = os.path.basename(e.path)
+                usage['dirents'] += 8 + ((len(name) + 3) & ~3)
+            if (e.type == 'd'):
+                usage['inodes'] += 1
+                usage['dirs'] += 1
+                os.mkdir(d)
+                made.append((d, e))
+                continue
+            if (e.ino not in seen):
+                seen.add(e.ino)
+                usage['inodes'] += 1
+                if (e.type == 'f'):
+                    # allocated blocks, so holes in sparse files are free
+                    usage['blocks'] += (e.blocks*512 + 4095) / 4096
+                elif (e.type == 'l' and e.size > 59):
+                    usage['blocks'] += 1
+            if (e.type == 'f'):
+                try:
+                    os.link(s, d)
+                except OSError, err:
+                    if (err.errno not in [ errno.EXDEV, errno.EPERM,
+                                           errno.EMLINK ]):
+                        raise
+                    fll.misc.cmd([ 'cp', '-a', '--sparse=always', s, d ],
+                                 silent=True)
+            elif (e.type == 'l'):
+                os.symlink(os.readlink(s), d)
+                os.lchown(d, e.uid, e.gid)
+            else:
+                os.mknod(d, e.mode, e.rdev)
+                made.append((d, e))
+        # set metadata last, adding entries changes the times of directories
+        for path, e in reversed(made):
+            os.lchown(path, e.uid, e.gid)
+            os.chmod(path, stat.S_IMODE(e.mode))
+            os.utime(path, (e.atime, e.mtime))
+        return(usage)
+
+    def mkfssize(self, usage, config):
+        """return the size in 4k blocks and inodes of a filesystem for the
+        usage of a farm. The size is that of the data, directories, inode
+        tables, group metadata and journal scaled by factor percent."""
+        inodes = (usage['inodes'] + 11) * config['factor'] / 100
+        dirblocks = usage['dirents'] / 4096 + usage['dirs']
+        # lost+found is 4 blocks
+        blocks = usage['blocks'] + dirblocks + inodes * 256 / 4096 + 4
+        # each group of 32768 blocks has a superblock and group descriptor
+        # backup at most, a block and inode bitmap and an extent block
+        blocks += (blocks / 32768 + 1) * 4
+        if (config['type'] != 'ext2'):
+            blocks += self.journalsize(blocks)
+        blocks = blocks * config['factor'] / 100
+        return(blocks, inodes)
+
+    def journalsize(self, blocks):
+        """return the default journal size of mke2fs in 4k blocks of a
+        filesystem of blocks 4k blocks"""
+        for limit, size in [ (2048, 0), (32768, 1024), (256*1024, 4096),
+                             (512*1024, 8192), (4096*1024, 16384),
+                             (8192*1024, 32768), (16384*1024, 65536),
+                             (32768*1024, 131072) ]:
+            if (blocks < limit):
+                return(size)
+        return(262144)
+
+    def mkfsmount(self):
+        """create a filesystem image of the chroot by copying it into a
+        loop mounted sparse file and shrinking it"""
+        config = self.config['mkfs']
+        filename, output = self.target('mkfs')
+        mfile = self.manifestfile(config, 'mkfs')
         self.chroot.cmd([ 'dd', 'if=/dev/zero',
                           'of=%s' % filename,
                           'bs=1',
@@ -117,9 +693,8 @@ class FsComp(object):
             fll.misc.cmd(['insmod', 'loop'])
         fll.misc.cmd(['mount', self.chroot.chroot_path(filename),
                                 self.chroot.chroot_path('/mnt') ])
-        self.chroot.cmd(['rsync', '-a', 
-                         '--exclude-from=%s' % self.excludesfile(config,filename),
-                         '/', '/mnt/' ])
+        self.chroot.cmd(['rsync', '-a', '--from0',
+                         '--files-from=%s' % mfile, '/', '/mnt/' ])
         fll.misc.cmd(['umount', self.chroot.chroot_path('/mnt') ])
         size = self.chroot.cmd(['du', '-m', filename ],
                                 pipe=True).split()[0]
@@ -129,13 +704,156 @@ class FsComp(object):
             os.symlink('/proc/mounts',self.chroot.chroot_path('/etc/mtab'))
         self.chroot.cmd([ 'resize2fs', filename, resize ])
         self.chroot.cmd([ 'truncate', '-s', resize, filename ])
-        if output != None:
-            shutil.move(self.chroot.chroot_path(filename),output)
-            self.output.append(output)
+        return(self.artifact(filename, output))
+
+    # the artifact of each backend in the chroot, unless it has a file
+    defaults = dict( squashfs='tmp/squash', tar='tmp/rootfs.tar',
+                     mkfs='tmp/rootfs' )
+
+    def target(self,comp):
+        """return the path in the chroot to write the artifact of backend
+        comp to and its output name, resolved once"""
+        if (comp not in self.targets):
+            config = self.config[comp]
+            default = self.defaults[comp]
+            if (comp == 'tar' and 'compressor' in config):
+                default = '%s.%s' % (default, config['compressor'])
+            self.targets[comp] = self.destination(config['file'], default)
+        return(self.targets[comp])
+
+    def destination(self,file,default):
+        """return the path in the chroot to write an artifact to and its
+        output name. An artifact with a file name is written directly to
+        it, through a bind mount of its directory in the chroot. Otherwise
+        it is written to default in the chroot."""
+        if (len(file) == 0):
+            return(default, default)
+        output = os.path.realpath(file)
+        outdir = os.path.dirname(output)
+        if (not os.path.isdir(outdir)):
+            os.makedirs(outdir)
+        with self.lock:
+            return(self.bind(output, outdir))
+
+    def bind(self,output,outdir):
+        """bind mount outdir in the chroot, unless it is already"""
+        for mnt, dirname in self.binds:
+            if (dirname == outdir):
+                break
         else:
-            self.output.append(filename)
+            mnt = '/tmp/fll-output-%i' % len(self.binds)
+            os.mkdir(self.chroot.chroot_path(mnt))
+            try:
+                fll.misc.mount(outdir, self.chroot.chroot_path(mnt), None,
+                               fll.misc.MS_BIND)
+            except OSError, e:
+                os.rmdir(self.chroot.chroot_path(mnt))
+                raise FsCompError(e)
+            self.binds.append((mnt, outdir))
+        return(os.path.join(mnt, os.path.basename(output)), output)
 
-    def excludesfile(self,config,filename):
+    def unbind(self):
+        """unmount the output directories bound in the chroot"""
+        self.targets.clear()
+        while (len(self.binds) > 0):
+            mnt, dirname = self.binds.pop()
+            try:
+                fll.misc.umount(self.chroot.chroot_path(mnt), lazy=True)
+            except OSError, e:
+                raise FsCompError(e)
+            os.rmdir(self.chroot.chroot_path(mnt))
+
+    def artifact(self,filename,output,digests=None):
+        """record an artifact written to filename in the chroot, and write
+        its checksums next to it. Returns output."""
+        self.artifacts[output] = filename
+        self.checksums(self.chroot.chroot_path(filename), digests)
+        return(output)
+
+    # the fifo in the chroot which streamed artifacts are written to
+    fifo = '/tmp/fll-stream'
+
+    def stream(self,cmd,path):
+        """execute cmd in the chroot, which writes to fifo, and write the
+        stream to path, hashing it on the way. Returns the digests."""
+        chfifo = self.chroot.chroot_path(self.fifo)
+        if (os.path.lexists(chfifo)):
+            os.unlink(chfifo)
+        os.mkfifo(chfifo, 0600)
+        rfd = os.open(chfifo, os.O_RDONLY | os.O_NONBLOCK)
+        # hold the fifo open for writing, reads then block until cmd writes
+        # and end when it is closed after cmd is done
+        wfd = os.open(chfifo, os.O_WRONLY)
+        flags = fcntl.fcntl(rfd, fcntl.F_GETFL)
+        fcntl.fcntl(rfd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        hashes = dict(sha256=hashlib.sha256(), sha512=hashlib.sha512())
+        digests = dict(size=0)
+        errors = list()
+
+        def copy():
+            fh = None
+            try:
+                fh = open(path, 'wb')
+            except IOError, e:
+                errors.append(e)
+            while True:
+                chunk = os.read(rfd, 2**20)
+                if (len(chunk) == 0):
+                    break
+                if (len(errors) > 0):
+                    # keep reading so that cmd is not blocked
+                    continue
+                try:
+                    fh.write(chunk)
+                except IOError, e:
+                    errors.append(e)
+                for h in hashes.values():
+                    h.update(chunk)
+                digests['size'] += len(chunk)
+            if (fh != None):
+                try:
+                    fh.close()
+                except IOError, e:
+                    errors.append(e)
+
+        thread = threading.Thread(target=copy)
+        thread.start()
+        try:
+            self.chroot.cmd(cmd)
+        finally:
+            os.close(wfd)
+            thread.join()
+            os.close(rfd)
+            os.unlink(chfifo)
+        if (len(errors) > 0):
+            raise FsCompError('failed to write %s: %s' % (path, errors[0]))
+        for name, h in hashes.items():
+            digests[name] = h.hexdigest()
+        return(digests)
+
+    def checksums(self,path,digests=None):
+        """write the size and SHA256 and SHA512 digests of path to
+        path.checksums, in the format of Debian Checksums fields. Unless
+        given, the digests are computed by reading path."""
+        if (digests == None):
+            hashes = dict(sha256=hashlib.sha256(), sha512=hashlib.sha512())
+            digests = dict(size=0)
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(2**20), ''):
+                    for h in hashes.values():
+                        h.update(chunk)
+                    digests['size'] += len(chunk)
+            for name, h in hashes.items():
+                digests[name] = h.hexdigest()
+        name = os.path.basename(path)
+        fh = open('%s.checksums' % path, 'w')
+        for field, digest in [ ('Checksums-Sha256', 'sha256'),
+                               ('Checksums-Sha512', 'sha512') ]:
+            print >>fh, '%s:' % field
+            print >>fh, ' %s %i %s' % (digests[digest], digests['size'], name)
+        fh.close()
+
+    def excludelist(self,config):
         """only the most specific excludes are used
         type config, class config, class data in that order """
         excludes=self.excludes
@@ -143,13 +861,53 @@ class FsComp(object):
             excludes = config['exclude']
         elif 'exclude' in self.config:
             excludes = self.config['exclude']
-        excludes.append(filename)
-        xfile='tmp/excludes'
+        return(list(excludes))
+
+    def manifest(self,config):
+        """return the manifest of the chroot less the excludes of config.
+        The chroot is walked once for each list of excludes."""
+        excludes = self.excludelist(config)
+        excludes.extend(self.workdirs)
+        key = tuple(excludes)
+        with self.lock:
+            if (key not in self.manifests):
+                try:
+                    self.manifests[key] = fll.manifest.Manifest(
+                        rootdir=self.chroot.rootdir, excludes=excludes)
+                except fll.manifest.ManifestError, e:
+                    raise FsCompError(e)
+            return(self.manifests[key])
+
+    def manifestfile(self,config,name):
+        """write the manifest of config to a file of NUL separated paths
+        for tar -T and rsync --files-from, named for the backend"""
+        mfile='tmp/fll-manifest-%s' % name
+        try:
+            self.manifest(config).write(self.chroot.chroot_path(mfile))
+        except fll.manifest.ManifestError, e:
+            raise FsCompError(e)
+        return(mfile)
+
+    def excludesfile(self,config):
+        """write the paths excluded from the manifest of config, the
+        artifacts of all backends and their checksums, the output
+        directories and the work paths to a file of exact paths for
+        mksquashfs -ef. Artifacts and work paths may be created after the
+        walk, by backends running concurrently."""
+        xfile='tmp/fll-excludes'
+        excludes = list(self.manifest(config).excluded)
+        excludes.append(xfile)
+        for filename, output in self.targets.values():
+            excludes.extend([filename.lstrip('/'),
+                             '%s.checksums' % filename.lstrip('/')])
+        excludes.extend([ mnt.lstrip('/') for mnt, dirname in self.binds ])
+        excludes.extend(self.workpaths)
         fh = open(self.chroot.chroot_path(xfile), 'w')
-        print >>fh, "\n".join(excludes) + "\n"
+        print >>fh, "\n".join(excludes)
         fh.close()
         return(xfile)
 
+    @fll.trace.traced('fscomp wrap')
     def wrap(self):
         """run the list in wrap"""
         if ( (self.config['wrap'][0] == 'none' ) or
@@ -158,31 +916,34 @@ class FsComp(object):
         for wrapper in self.config['wrap']:
             if wrapper == 'iso':
                 config = self.config['iso']
-                input = self.output[ len(self.output)-1 ]
-                output = None
-                if (len(config['file']) > 0):
-                    filename = config['file']
-                    output = filename
-                else:
-                    filename = '%s.iso' % input
-                os.mkdir(self.chroot.chroot_path('/tmp/iso'))
-                #self.chroot.cmd(['cp', '-a', '/boot', '/tmp/iso/'])
-                self.stage('/tmp/iso')
-                cmd = [ 'grub-mkrescue', '-o', filename, '/tmp/iso', '--',
-                        '--append_partition', '2', '0x83', input ]
-            self.chroot.cmd(cmd)
-        if output != None:
-            shutil.move(self.chroot.chroot_path(filename),output)
-            self.output.append(output)
-        else:
-            self.output.append(filename)
+                input = self.output[0]
+                chinput = self.artifacts[input]
+                filename, output = self.destination(config['file'],
+                                                    '%s.iso' % chinput)
+                if (len(config['file']) == 0):
+                    output = '%s.iso' % input
+                cmd = [ 'grub-mkrescue', '-o', filename, self.isodir, '--',
+                        '--append_partition', '2', '0x83', chinput ]
+                self.chroot.cmd(cmd)
+                self.output.append(self.artifact(filename, output))
+
+    @fll.trace.traced('fscomp prewrap')
+    def prewrap(self):
+        """stage what the wrappers need, while the chroot is compressed"""
+        if ('iso' in self.config['wrap']):
+            isodir = self.chroot.chroot_path(self.isodir)
+            if (os.path.exists(isodir)):
+                shutil.rmtree(isodir)
+            os.mkdir(isodir)
+            #self.chroot.cmd(['cp', '-a', '/boot', self.isodir])
+            self.stage(self.isodir)
 
     def stage(self,path):
         """put required files needed in path"""
         chroot = self.chroot
         if ( not os.path.exists( chroot.chroot_path( path ) ) ):
             return()
-        chpath = chroot.chroot_path('/tmp/iso')
+        chpath = chroot.chroot_path(path)
         bpath = os.path.join(chpath, 'boot')
         gpath = os.path.join(bpath, 'grub')
         os.mkdir(bpath)
@@ -8,6 +8,8 @@ Copyright: Copyright (C) 2008 Kel Modderman <kel@otaku42.de>
 License:   GPL-2
 """
 
+import bisect
+
 
 """
 This dict contains fallback strings for specific locales. It is used
@@ -42,7 +44,9 @@ class FllLocalesError(Exception):
 class FllLocales(object):
     """
     A class which provides the ability to determine lists of locale specific
-    Debian packages using it's detect_locale_packages method.
+    Debian packages using it's detect_locale_packages method, or its
+    detect_many method for several locales at once. The names of the
+    available packages are indexed once, at instantiation.
 
     Arguments:
     cache    - an apt_pkg cache object
@@ -55,28 +59,33 @@ class FllLocales(object):
                ConfigObj('data/fll-locales-pkg-map').
     """
     def __init__(self, cache, packages, map):
+        # The names of the available packages, sorted so that the names
+        # beginning with a prefix are found by bisection.
+        self.names = sorted(set([pkg.name for pkg in cache.packages
+                                 if pkg.version_list]))
+        available = set(self.names)
+
         self.loc_pkgs_set = set()
-        for pkg in cache.packages:
-            if not pkg.version_list:
-                continue
-            if pkg.name not in packages:
-                continue
-            for loc_pkg in map.keys():
-                if pkg.name == loc_pkg:
-                    loc_pkg_prefix_list = map.get(loc_pkg)
-                    for loc_pkg_prefix in loc_pkg_prefix_list:
-                        self.loc_pkgs_set.add(loc_pkg_prefix)
-                    break
+        for loc_pkg, loc_pkg_prefix_list in map.iteritems():
+            if loc_pkg in packages and loc_pkg in available:
+                self.loc_pkgs_set.update(loc_pkg_prefix_list)
 
         self.loc_pkgs_list_dict = dict()
         for loc_pkg in self.loc_pkgs_set:
-            self.loc_pkgs_list_dict[loc_pkg] = list()
-        for pkg in cache.packages:
-            if not pkg.version_list:
-                continue
-            for loc_pkg in self.loc_pkgs_set:
-                if pkg.name.startswith(loc_pkg + '-'):
-                    self.loc_pkgs_list_dict[loc_pkg].append(pkg.name)
+            self.loc_pkgs_list_dict[loc_pkg] = self.__prefixed(loc_pkg + '-')
+
+    def __prefixed(self, prefix):
+        """
+        Return the names of the available packages which begin with prefix.
+
+        This is a very private method, used at FllLocales instantiation.
+        """
+        names = list()
+        for name in self.names[bisect.bisect_left(self.names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
 
     def __compute_locale_loc_suf_list(self, locale):
         """
@@ -124,26 +133,31 @@ class FllLocales(object):
         Arguments:
         locale - a locale string (eg. en_AU, pt_PT etc.)
         """
-        suffixes = self.__compute_locale_loc_suf_list(locale)
+        return self.detect_many([locale])[locale]
 
-        loc_pkg_dict = dict()
-        for pkg in self.loc_pkgs_set:
-            loc_pkgs_list = self.loc_pkgs_list_dict.get(pkg)
-            if not loc_pkgs_list:
-                continue
-            if pkg not in loc_pkg_dict:
-                loc_pkg_dict[pkg] = dict()
-            for loc_pkg in loc_pkgs_list:
-                for idx, suf in enumerate(suffixes):
-                    if loc_pkg == '-'.join([pkg, suf]):
-                       loc_pkg_dict[pkg][idx] = loc_pkg
-
-        packages = list()
+    def detect_many(self, locales):
+        """
+        As detect_locale_packages, for each of a list of locales in one
+        pass over the locale packages. Returns a dict of the list of
+        package names of each locale.
+
+        Arguments:
+        locales - a list of locale strings (eg. en_AU, pt_PT etc.)
+        """
+        suffixes = dict()
+        for locale in locales:
+            suffixes[locale] = self.__compute_locale_loc_suf_list(locale)
+
+        packages = dict([(locale, list()) for locale in locales])
         for pkg in self.loc_pkgs_set:
-            pkg_candidates = loc_pkg_dict.get(pkg)
-            if not pkg_candidates:
+            loc_pkgs = set(self.loc_pkgs_list_dict.get(pkg, []))
+            if not loc_pkgs:
                 continue
-            best = min(pkg_candidates)
-            packages.append(pkg_candidates[best])
+            for locale in locales:
+                for suf in suffixes[locale]:
+                    loc_pkg = '-'.join([pkg, suf])
+                    if loc_pkg in loc_pkgs:
+                        packages[locale].append(loc_pkg)
+                        break
 
         return packages
@@ -0,0 +1,197 @@
+"""
+This is the fll.manifest module, it provides classes for matching exclude
+patterns and for listing the files of a chroot, less the excludes, in a
+single walk which all filesystem image backends share.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+from collections import namedtuple
+
+import os
+import re
+import stat
+
+
+class ManifestError(Exception):
+    """
+    An Error class for use by Manifest.
+    """
+    pass
+
+
+Entry = namedtuple('Entry', 'path type size blocks mode uid gid ino nlink '
+                            'rdev atime mtime')
+
+
+def translate(pattern):
+    """Translate a wildcard pattern to a regular expression. A * or ? does
+    not match a /, as with mksquashfs -wildcards. A leading ./ or / is
+    ignored, patterns are relative to the top of the chroot."""
+    pattern = pattern.strip()
+    if pattern.startswith('./'):
+        pattern = pattern[2:]
+    pattern = pattern.strip('/')
+
+    i = 0
+    n = len(pattern)
+    res = ''
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            res += '[^/]*'
+        elif c == '?':
+            res += '[^/]'
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res += '\\['
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] in '!^':
+                    stuff = '^' + stuff[1:]
+                res += '[%s]' % stuff
+        elif c == '\\' and i < n:
+            res += re.escape(pattern[i])
+            i += 1
+        else:
+            res += re.escape(c)
+    return res
+
+
+class Matcher(object):
+    """
+    A class which matches paths against a list of exclude patterns,
+    compiled to a single regular expression. A path matches if a pattern
+    matches the path or one of its parent directories.
+
+    Options   Type   Description
+    --------------------------------------------------------------------------
+    patterns - (list) wildcard patterns
+    """
+    def __init__(self, patterns=[]):
+        patterns = [p for p in patterns if p.strip().strip('./')]
+        self.patterns = patterns
+        if patterns:
+            regex = '(?:%s)(?:/|$)' % '|'.join([translate(p)
+                                                 for p in patterns])
+            self.regex = re.compile(regex)
+        else:
+            self.regex = None
+
+    def __call__(self, path):
+        if self.regex is None:
+            return False
+        return self.regex.match(path.lstrip('/')) is not None
+
+
+class Manifest(object):
+    """
+    A class which lists the entries of a chroot, less the excludes, in a
+    single walk. The walk does not cross into other filesystems mounted in
+    the chroot. Entries are ordered so that a directory precedes its
+    contents, their paths are relative to the top of the chroot which is
+    the entry with a path of ''.
+
+    Options   Type   Description
+    --------------------------------------------------------------------------
+    rootdir  - (str)  path to chroot
+    excludes - (list) wildcard patterns of paths to exclude
+    """
+    types = {stat.S_IFDIR: 'd', stat.S_IFREG: 'f', stat.S_IFLNK: 'l',
+             stat.S_IFCHR: 'c', stat.S_IFBLK: 'b', stat.S_IFIFO: 'p',
+             stat.S_IFSOCK: 's'}
+
+    def __init__(self, rootdir=None, excludes=[]):
+        if not rootdir:
+            raise ManifestError('must specify rootdir=')
+
+        self.rootdir = rootdir
+        self.matcher = Matcher(excludes)
+        self.entries = list()
+        self.excluded = list()
+        self.size = 0
+        self.blocks = 0
+        self._walk()
+
+    def _walk(self):
+        try:
+            rootdev = os.lstat(self.rootdir).st_dev
+            dirs = ['']
+            while dirs:
+                rel = dirs.pop()
+                path = os.path.join(self.rootdir, rel)
+                st = os.lstat(path)
+                self._add(rel, st)
+                if st.st_dev != rootdev:
+                    continue
+                subdirs = list()
+                for name in sorted(os.listdir(path)):
+                    relname = os.path.join(rel, name)
+                    if self.matcher(relname):
+                        self.excluded.append(relname)
+                        continue
+                    st = os.lstat(os.path.join(path, name))
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs.append(relname)
+                    else:
+                        self._add(relname, st)
+                dirs.extend(reversed(subdirs))
+        except OSError, e:
+            raise ManifestError('failed to walk %s: %s' % (self.rootdir, e))
+
+    def _entry(self, path, st):
+        return Entry(path, self.types.get(stat.S_IFMT(st.st_mode), '?'),
+                     st.st_size, st.st_blocks, st.st_mode, st.st_uid,
+                     st.st_gid, st.st_ino, st.st_nlink, st.st_rdev,
+                     st.st_atime, st.st_mtime)
+
+    def _add(self, path, st):
+        entry = self._entry(path, st)
+        if entry.type == 'f':
+            self.size += entry.size
+            self.blocks += entry.blocks
+        self.entries.append(entry)
+
+    def refresh(self, paths):
+        """Update the entries of paths, after they were changed."""
+        index = dict([(e.path, i) for i, e in enumerate(self.entries)])
+        try:
+            for path in paths:
+                i = index[path]
+                old = self.entries[i]
+                new = self._entry(path, os.lstat(os.path.join(self.rootdir,
+                                                              path)))
+                if old.type == 'f':
+                    self.size -= old.size
+                    self.blocks -= old.blocks
+                if new.type == 'f':
+                    self.size += new.size
+                    self.blocks += new.blocks
+                self.entries[i] = new
+        except OSError, e:
+            raise ManifestError('failed to refresh %s: %s' % (path, e))
+
+    def files(self):
+        """Return the entries of regular files."""
+        return [e for e in self.entries if e.type == 'f']
+
+    def write(self, filename, prefix='./', sep='\0'):
+        """Write the paths of the entries to filename, each with prefix
+        and followed by sep. The top of the chroot is written as '.'."""
+        try:
+            with open(filename, 'w') as fh:
+                for e in self.entries:
+                    fh.write((e.path and prefix + e.path or '.') + sep)
+        except IOError, e:
+            raise ManifestError('failed to write manifest: %s' % e)
@@ -1,9 +1,20 @@
+import ctypes
+import ctypes.util
+import errno
 import shlex
 import signal
 import subprocess
 import os
 import pprint
 import sys
+import time
+import fll.trace
+
+# mount(2) and umount2(2) flags, from <sys/mount.h>
+MS_BIND = 4096
+MNT_DETACH = 2
+
+_libc = None
 
 def debug(mode, title, obj):
     if mode is False:
@@ -20,8 +31,8 @@ def restore_sigpipe():
     SIGPIPE restored to default (http://bugs.python.org/issue1652)."""
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-def cmd(cmd, pipe=False, quiet=False, silent=False):
-    """Execute a command."""
+def cmd(cmd, pipe=False, quiet=False, silent=False, env=None):
+    """Execute a command, in the environment env if it is not None."""
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
 
@@ -30,24 +41,27 @@ def cmd(cmd, pipe=False, quiet=False, silent=False):
 
     devnull = output = None
 
-    try:
-        if pipe:
-            proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
-                                    stdout=subprocess.PIPE)
-            output = proc.communicate()[0]
-        elif quiet or silent:
-            devnull = os.open(os.devnull, os.O_RDWR)
-            proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
-                                    stdout=devnull)
-            proc.wait()
-        else:
-            proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe)
-            proc.wait()
-    except OSError, e:
-        raise OSError('command failed: %s' % e)
-    finally:
-        if devnull:
-            os.close(devnull)
+    with fll.trace.span(os.path.basename(cmd[0]), 'host',
+                        cmd=' '.join(cmd)) as args:
+        try:
+            if pipe:
+                proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
+                                        env=env, stdout=subprocess.PIPE)
+                output = proc.stdout.read()
+                proc.stdout.close()
+            elif quiet or silent:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
+                                        env=env, stdout=devnull)
+            else:
+                proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
+                                        env=env)
+            args.update(wait(proc))
+        except OSError, e:
+            raise OSError('command failed: %s' % e)
+        finally:
+            if devnull:
+                os.close(devnull)
 
     if proc.returncode != 0:
         raise OSError('command returncode=%d: %s' % \
@@ -55,3 +69,81 @@ def cmd(cmd, pipe=False, quiet=False, silent=False):
 
     if pipe:
         return output
+
+def wait(proc):
+    """Wait for the process of a subprocess.Popen object to exit and set
+    its returncode, as per proc.wait(). Returns its usage as per
+    fll.trace.usage(), of the process and the children it waited for. If
+    tracing, its /proc/<pid>/io is sampled until it has exited, but is not
+    yet reaped. Otherwise it is waited for without polling."""
+    io = dict()
+    delay = 0.001
+    rusage = None
+    if not fll.trace.enabled():
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    while rusage is None:
+        try:
+            with open('/proc/%d/stat' % proc.pid) as fh:
+                exited = fh.read().rpartition(')')[2].split()[0] == 'Z'
+        except (IOError, IndexError):
+            exited = False
+        io = fll.trace.procio(proc.pid) or io
+        if exited:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        rusage = None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.02)
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return fll.trace.usage(rusage, io)
+
+def _libcall(name, *args):
+    """Call a libc function. Returns its return value and errno."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    ret = getattr(_libc, name)(*args)
+    return ret, ret < 0 and ctypes.get_errno() or 0
+
+def _syscall(name, *args):
+    """Call a libc function. Returns errno if it fails, otherwise 0."""
+    ret, err = _libcall(name, *args)
+    if ret != 0:
+        return err
+    return 0
+
+def listxattr(path):
+    """Return the names of the extended attributes of path, not following
+    a symlink."""
+    ret, err = _libcall('llistxattr', path, None, 0)
+    if ret > 0:
+        buf = ctypes.create_string_buffer(ret)
+        ret, err = _libcall('llistxattr', path, buf, ret)
+        if ret > 0:
+            return [n for n in buf.raw[:ret].split('\0') if n]
+    if ret < 0 and err not in (errno.ENOTSUP, errno.ENOSYS):
+        raise OSError(err, 'llistxattr %s: %s' % (path, os.strerror(err)))
+    return []
+
+def mount(source, target, fstype, flags=0, data=None):
+    """Mount a filesystem with the mount(2) system call, instead of
+    executing mount(8)."""
+    err = _syscall('mount', source, target, fstype, flags, data)
+    if err:
+        raise OSError(err, 'mount %s: %s' % (target, os.strerror(err)))
+
+def umount(target, lazy=False):
+    """Unmount a filesystem with the umount2(2) system call. A busy
+    filesystem is lazily unmounted if lazy is True."""
+    err = _syscall('umount2', target, 0)
+    if err == errno.EBUSY and lazy:
+        err = _syscall('umount2', target, MNT_DETACH)
+    if err:
+        raise OSError(err, 'umount %s: %s' % (target, os.strerror(err)))
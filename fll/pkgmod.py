@@ -7,8 +7,14 @@ Copyright: Copyright (C) 2012 Kel Modderman <kel@otaku42.de>
 License:   GPL-2
 """
 
+from configobj import ConfigObj, ConfigObjError
+from fll.locales import FllLocales, FllLocalesError
+
+import fll.cache
 import fnmatch
+import json
 import os
+import shutil
 
 class PkgModError(Exception):
     """
@@ -21,38 +27,55 @@ class PkgMod(object):
     """
     A class for parsing package profile modules.
 
+    A profile (<name>.profile) includes package lists (*.list) with
+    '#include <list> ...' lines. A list names packages, one or more per
+    line, and may include other lists and profiles in the same way. Text
+    after a '#' is a comment. Each included list is overlaid by the list of
+    the same name suffixed with the architecture (<list>.<arch>), if there
+    is one. Includes are followed to any depth, each file is parsed once
+    however often it is included and a cycle of includes is an error.
+
+    If config['cache'] is set, the packages of each profile and
+    architecture are cached there, with the mtimes and sizes of the files
+    they were parsed from and of the directories of the profile module, so
+    that the profile is not parsed again until one of them changes. The
+    profile module is walked either way, so that profiles, lists, debconf
+    and postinst are found whether or not the packages were cached.
+
     Options        Type                Description
     --------------------------------------------------------------------------
     aptlib       - (fll.aptlib.AptLib) fll.aptlib.AptLib object
     architecture - (str)               Architecture codename
     config       - (dict)              The 'profile' section of a
                                        fll.config.Config object
-    locales      - (dict)              dict of locales to be considered when
+    locales      - (list)              list of locales to be considered when
                                        selecting packages from apt's cache
+    localesmap   - (dict)              map of packages to the prefixes of
+                                       their locale packages, as per
+                                       fll.locales.FllLocales. Defaults to
+                                       data/locales-pkg-map
     """
-    def __init__(self, aptlib=None, architecture=None, config={}, locales={}):
+    include = '#include '
+
+    def __init__(self, aptlib=None, architecture=None, config={}, locales=[],
+                 localesmap=None):
         self.apt = aptlib
         self.arch = architecture
         self.config = config
         self.locales = locales
+        self.localesmap = localesmap
         self.pkgs = set()
         self.profiles = {}
         self.lists = {}
         self.debconf = {}
         self.postinst = {}
+        self.dirs = {}
 
-        try:
+        if config.get('dir'):
             self.locate_files(config['dir'])
-        except KeyError:
-            # this seems to be pointless?
-            self.modules = {}
-
-        try:
-            self.profile = config['name']
-        except KeyError:
-            self.profile = None
 
-        if self.profile != None and len(self.profiles.keys()) > 0:
+        self.profile = config.get('name')
+        if self.profile:
             self.pkgs.update(self.expand_profile())
 
         try:
@@ -60,19 +83,23 @@ class PkgMod(object):
         except KeyError:
             pass
 
+        if self.locales and self.apt is not None:
+            self.pkgs.update(self.locale_packages())
+
     def locate_files(self, dirname):
+        """Find the profiles, lists, debconf and postinst files of the
+        profile module in dirname, and note the mtimes of its
+        directories."""
         for path, dirs, files in os.walk(dirname):
-            for d in dirs:
-                if d.startswith('.'):
-                    dirs.remove(d)
-            
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            self.dirs[path] = os.stat(path).st_mtime
+
             for f in fnmatch.filter(files, '*.profile'):
                 profile = f.rsplit('.', 1)[0]
                 self.profiles[profile] = os.path.join(path, f)
 
             for f in fnmatch.filter(files, '*.list') + \
                      fnmatch.filter(files, '*.list.%s' % self.arch):
-                print f
                 self.lists[f] = os.path.join(path, f)
 
             for f in fnmatch.filter(files, '*.debconf'):
@@ -81,50 +108,138 @@ class PkgMod(object):
             for f in fnmatch.filter(files, '*.postinst'):
                 self.postinst[f] = os.path.join(path, f)
 
-    def expand_profile(self):
-        lists = []
-        pkgs = []
-        if self.profile in self.profiles:
-            fname = self.profiles[self.profile]
-        else:
-            raise PkgModError('unknown package profile: %s' % self.profile)
-        
-        fh = None
+    def locale_packages(self):
+        """Return the locale support packages of the packages of the
+        profile, for all locales."""
+        if self.localesmap is None:
+            if os.path.isfile('data/locales-pkg-map'):
+                fname = 'data/locales-pkg-map'
+            else:
+                fname = '/usr/share/fll/data/locales-pkg-map'
+            try:
+                self.localesmap = ConfigObj(fname, file_error=True)
+            except (ConfigObjError, IOError), e:
+                raise PkgModError('failed to read %s: %s' % (fname, e))
+
         try:
-            fh = open(fname, 'r')
-            for line in fh.readlines():
-                if not line.startswith('#include '):
-                    continue
-                for l in line.split()[1:]:
-                    if l in self.lists:
-                        print l
-                        lists.append(self.lists[l])
-                    else:
-                        raise PkgModError('unknown package list: %s' % l)
-
-                    arch_l = '%s.%s' % (l, self.arch)
-                    if arch_l in self.lists:
-                        lists.append(self.lists[arch_l])
-
-                    # XXX: debconf + postinst
-        except:
-            pass
-        finally:
-            if fh:
-                fh.close()
+            locales = FllLocales(self.apt.cache._cache, self.pkgs,
+                                 self.localesmap)
+            detected = locales.detect_many(list(self.locales))
+        except FllLocalesError, e:
+            raise PkgModError('bad locale: %s' % e)
+
+        pkgs = set()
+        for locale, packages in detected.iteritems():
+            pkgs.update(packages)
+        return pkgs
 
-        for fname in lists:
-            fh = None
+    def expand_profile(self):
+        """Return the packages of the profile, from the cache if none of
+        the files and directories it depends on changed."""
+        cache = None
+        if self.config.get('cache'):
             try:
-                fh = open(fname, 'r')
-                for line in fh.readlines():
-                    if not line:
-                        continue
-                    pkgs.append(line.strip())
-            except:
-                pass
-            finally:
-                if fh:
-                    fh.close()
+                cache = fll.cache.Cache(dirname=self.config['cache'])
+            except fll.cache.CacheError, e:
+                raise PkgModError(e)
+            key = fll.cache.digest(self.profile, self.arch,
+                                   os.path.realpath(self.config['dir']))
+            pkgs = self._cached(cache, key)
+            if pkgs is not None:
+                print 'PKGMOD %s cached' % self.profile
+                return pkgs
+
+        if self.profile not in self.profiles:
+            raise PkgModError('unknown package profile: %s' % self.profile)
+
+        self._memo = dict()
+        pkgs = self._expand(self.profiles[self.profile], [])
+        print 'PKGMOD %s %d packages from %d files' % \
+            (self.profile, len(pkgs), len(self._memo))
 
+        if cache:
+            self._store(cache, key, pkgs)
         return pkgs
+
+    def _expand(self, fname, stack):
+        """Return the packages of a profile or list file and of those it
+        includes. stack is the chain of files which included it."""
+        if fname in stack:
+            chain = stack[stack.index(fname):] + [fname]
+            raise PkgModError('cycle of includes: %s' %
+                              ' -> '.join(map(os.path.basename, chain)))
+        if fname in self._memo:
+            return self._memo[fname]
+
+        profile = fname.endswith('.profile')
+        pkgs = set()
+        try:
+            with open(fname) as fh:
+                for line in fh:
+                    if line.startswith(self.include):
+                        for name in line.split('#')[1].split()[1:]:
+                            for f in self._include(name, fname):
+                                pkgs.update(self._expand(f, stack + [fname]))
+                    elif not profile:
+                        pkgs.update(line.split('#', 1)[0].split())
+        except IOError, e:
+            raise PkgModError('failed to read %s: %s' % (fname, e))
+
+        self._memo[fname] = pkgs
+        return pkgs
+
+    def _include(self, name, fname):
+        """Return the files included by name: a profile, or a list and its
+        overlay for the architecture."""
+        if name in self.lists:
+            files = [self.lists[name]]
+            overlay = '%s.%s' % (name, self.arch)
+            if overlay in self.lists:
+                files.append(self.lists[overlay])
+            return files
+        profile = name.endswith('.profile') and name.rsplit('.', 1)[0] \
+                  or name
+        if profile in self.profiles:
+            return [self.profiles[profile]]
+        raise PkgModError('unknown package list: %s (included by %s)' %
+                          (name, fname))
+
+    def _cached(self, cache, key):
+        """Return the cached packages of key, or None if there are none,
+        the directories of the profile module have changed or any file they
+        were parsed from has changed."""
+        path = cache.lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path) as fh:
+                entry = json.load(fh)
+            if entry['dirs'] != self.dirs:
+                return None
+            for fname, (mtime, size) in entry['files'].iteritems():
+                st = os.stat(fname)
+                if st.st_mtime != mtime or st.st_size != size:
+                    return None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return set(map(str, entry['pkgs']))
+
+    def _store(self, cache, key, pkgs):
+        """Cache the packages of key, with the mtimes and sizes of the
+        files they were parsed from and of the directories of the profile
+        module. Failure to do so is not fatal."""
+        files = dict()
+        for fname in self._memo:
+            st = os.stat(fname)
+            files[fname] = (st.st_mtime, st.st_size)
+        entry = dict(dirs=self.dirs, files=files, pkgs=sorted(pkgs))
+        tmpdir = cache.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, key), 'w') as fh:
+                json.dump(entry, fh)
+            cache.store(key, os.path.join(tmpdir, key), move=True,
+                        replace=True)
+        except (IOError, OSError, fll.cache.CacheError), e:
+            print 'PKGMOD failed to cache %s: %s' % (self.profile, e)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,227 @@
+"""
+This is the fll.plan module, it provides a class for planning a build
+without bootstrapping a chroot: which packages would be installed, how much
+would be downloaded, how much space they would take and how large the
+compressed images would be. It also provides a class for fetching the
+archives of a build in the background, while its chroot is bootstrapped.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+from fll.aptlib import AptLib, AptLibError
+from fll.fscomp import FsComp, FsCompError
+from fll.pkgmod import PkgMod, PkgModError
+
+import apt_pkg
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+import fll.trace
+
+
+class PlanError(Exception):
+    """
+    An Error class for use by Plan.
+    """
+    pass
+
+
+class Plan(object):
+    """
+    A class for planning the build of an architecture. apt is prepared in a
+    temporary directory on the host, which stands in for the chroot, and the
+    packages of the build are marked for installation as bin/fll marks them,
+    on top of the essential and required packages a bootstrap would
+    install. Nothing is installed and nothing but apt's package indexes is
+    downloaded. The signatures of the apt sources are not verified, so the
+    package indexes are never stored in the cache of package indexes.
+
+    Options        Type   Description
+    --------------------------------------------------------------------------
+    architecture - (str)  architecture to plan the build of
+    config       - (dict) fll.config.Config object's config
+    dirname      - (str)  directory to create the temporary directory in
+    """
+    def __init__(self, architecture=None, config={}, dirname=None):
+        if architecture is None:
+            raise PlanError('must specify architecture=')
+        if not config:
+            raise PlanError('must specify config=')
+
+        self.architecture = architecture
+        self.config = config
+        self.dirname = dirname
+        self.rootdir = None
+
+    def __enter__(self):
+        self.rootdir = tempfile.mkdtemp(prefix='.fll-plan-', dir=self.dirname)
+        os.makedirs(self.chroot_path('/etc/apt/sources.list.d'))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.rootdir)
+        self.rootdir = None
+
+    # The part of the fll.chroot.Chroot interface which AptLib uses.
+    def chroot_path(self, path):
+        return os.path.join(self.rootdir, path.lstrip('/'))
+
+    def chroot_path_rel(self, path):
+        return path.replace(self.rootdir, '')
+
+    def require_space(self, nbytes):
+        pass
+
+    def cmd(self, cmd, pipe=False, quiet=False, silent=False):
+        raise PlanError('cannot execute %s without a chroot' % cmd[0])
+
+    def aptconfig(self, pool=False):
+        """Return the 'apt' section of the config, without gpg keys and,
+        unless pool is True, without a package pool. The cache of package
+        indexes is read only, as the indexes apt fetches are not
+        verified."""
+        config = dict(self.config['apt'])
+        config['key'] = dict(config['key'], disable=True)
+        config['lists'] = dict(config['lists'], readonly=True)
+        if not pool:
+            config['pool'] = dict(config['pool'], dir='')
+        config['conf'] = dict(config['conf'])
+        config['conf']['Acquire::AllowInsecureRepositories'] = 'true'
+        return config
+
+    def bootstrapped(self, apt):
+        """Return the names of the packages a bootstrap of the configured
+        flavour would install: the essential and required packages, the
+        important ones too for the standard flavour and build-essential for
+        the build flavour, and the included ones, less the excluded
+        ones."""
+        config = self.config['chroot']['bootstrap']
+        priorities = ['required']
+        if config['flavour'] == 'standard':
+            priorities.append('important')
+        pkgs = set([pkg.name for pkg in apt.cache if pkg.essential or
+                    pkg.candidate and pkg.candidate.priority in priorities])
+        if config['flavour'] == 'build':
+            pkgs.add('build-essential')
+        pkgs.update([p for p in config['include'].split(',') if p])
+        pkgs.difference_update(config['exclude'].split(','))
+        return pkgs
+
+    @fll.trace.traced('plan')
+    def plan(self, prefetch=False):
+        """Print and return the plan of the build: a dict of the names of
+        the packages to be installed, the bytes to be downloaded, the bytes
+        they take when installed and a list of (compression, size, basis)
+        of the estimated sizes of the images. If prefetch is True, the
+        archives of the packages to be installed after the bootstrap are
+        fetched into the package pool, and the changes are not printed."""
+        apt = AptLib(chroot=self, config=self.aptconfig(pool=prefetch))
+
+        pkgs = self.bootstrapped(apt)
+        apt.install(pkgs, commit=False)
+        bootstrapped = set([p.name for p in apt.changes()])
+        pkgs.update(self.config['chroot']['layers']['packages'])
+        pm = PkgMod(aptlib=apt, architecture=self.architecture,
+                    config=self.config['profile'],
+                    locales=self.config['profile']['locales'])
+        pkgs.update(pm.pkgs)
+        fscomp = FsComp(chroot=self, config=self.config['fscomp'])
+        pkgs.update(fscomp.depends)
+
+        apt.install(pkgs, commit=False)
+        if prefetch:
+            apt.prefetch(exclude=bootstrapped)
+        else:
+            for change in apt.changes():
+                print change
+
+        plan = dict(packages=sorted([p.name for p in apt.changes()]),
+                    download=apt.cache.required_download,
+                    installed=apt.cache.required_space)
+        plan['images'] = fscomp.estimate(plan['installed'])
+
+        print 'PLAN %s INSTALL %d GET %sB REQ %sB' % \
+            (self.architecture, len(plan['packages']),
+             apt_pkg.size_to_str(plan['download']),
+             apt_pkg.size_to_str(plan['installed']))
+        for comp, size, basis in plan['images']:
+            print 'PLAN %s IMAGE %s %sB (%s)' % \
+                (self.architecture, comp, apt_pkg.size_to_str(size), basis)
+        return plan
+
+
+class Prefetch(object):
+    """
+    A class for fetching the archives of the packages of a build into the
+    package pool while the chroot is bootstrapped and initialised, so that
+    apt finds them there when it installs them. The packages are those of
+    the plan of the build, less those the bootstrap installs. The plan is
+    made and fetched in a process of its own, as apt_pkg's configuration is
+    global to a process. Prefetching needs a package pool, failing to
+    prefetch does not fail the build.
+
+    Options        Type   Description
+    --------------------------------------------------------------------------
+    architecture - (str)  architecture of the build
+    config       - (dict) fll.config.Config object's config
+    """
+    def __init__(self, architecture=None, config={}):
+        if architecture is None:
+            raise PlanError('must specify architecture=')
+        if not config:
+            raise PlanError('must specify config=')
+
+        self.architecture = architecture
+        self.config = config
+        self.proc = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.proc is not None and self.proc.is_alive():
+            self.proc.terminate()
+        self.join()
+
+    def start(self):
+        """Start fetching, if prefetching is enabled."""
+        if not self.config['apt']['prefetch']:
+            return
+        if not self.config['apt']['pool']['dir']:
+            print 'APT PREFETCH disabled: no package pool'
+            return
+        print 'APT PREFETCH %s' % self.architecture
+        self.proc = multiprocessing.Process(target=self._prefetch)
+        self.proc.start()
+
+    def _prefetch(self):
+        # clean up as on an interrupt when terminated by __exit__()
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            with Plan(architecture=self.architecture, config=self.config,
+                      dirname=self.config['apt']['pool']['dir']) as plan:
+                plan.plan(prefetch=True)
+        except (AptLibError, FsCompError, PkgModError, PlanError, OSError), e:
+            print 'APT PREFETCH failed: %s' % e
+            sys.exit(1)
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+    def join(self):
+        """Wait for fetching to finish."""
+        if self.proc is None:
+            return
+        with fll.trace.span('apt prefetch'):
+            self.proc.join()
+        if self.proc.exitcode == 0:
+            print 'APT PREFETCH finished'
+        else:
+            print 'APT PREFETCH failed (exitcode=%d)' % self.proc.exitcode
+        self.proc = None
@@ -0,0 +1,246 @@
+"""
+This is the fll.trace module, it records the time and resources spent in
+each phase of a build and in each command it executes. The record is
+written as a Chrome trace (viewable with chrome://tracing or
+https://ui.perfetto.dev) and summarised in a table of the phases and
+commands which took the longest.
+
+Author:    fll contributors
+Copyright: Copyright (C) 2026 fll contributors
+License:   GPL-2
+"""
+
+from contextlib import contextmanager
+
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+
+class TraceError(Exception):
+    """
+    An Error class for use by Trace.
+    """
+    pass
+
+
+def procio(pid='self'):
+    """Return the I/O counters of /proc/<pid>/io as a dict, which is empty
+    if they are not available."""
+    try:
+        with open('/proc/%s/io' % pid) as fh:
+            return dict([(k, int(v)) for k, v in
+                         [line.split(':') for line in fh if ':' in line]])
+    except (IOError, ValueError):
+        return dict()
+
+
+def usage(rusage, io={}):
+    """Return the resource usage of a process, from its rusage and its
+    /proc/<pid>/io counters: user and system CPU seconds, peak RSS in kB,
+    bytes read from and written to block devices, and bytes read and
+    written by any means (disk, pipes, the network)."""
+    return dict(utime=rusage.ru_utime, stime=rusage.ru_stime,
+                maxrss=rusage.ru_maxrss, inblock=rusage.ru_inblock * 512,
+                oublock=rusage.ru_oublock * 512, rchar=io.get('rchar', 0),
+                wchar=io.get('wchar', 0))
+
+
+def _usage():
+    """Return the usage of this process and its reaped children so far."""
+    own = usage(resource.getrusage(resource.RUSAGE_SELF), procio())
+    children = usage(resource.getrusage(resource.RUSAGE_CHILDREN))
+    total = dict([(k, own[k] + children[k]) for k in own])
+    total['maxrss'] = max(own['maxrss'], children['maxrss'])
+    return total
+
+
+class Trace(object):
+    """
+    A class which records spans of time. A span has a name, a category
+    (phase, host or chroot) and may have args. Spans may be recorded by
+    any thread, and nest within the spans of the same thread.
+
+    The args of a host or chroot command span are the usage of the command
+    and the children it waited for. The args of a phase span are the usage
+    of fll and all the children it reaped during the phase, except maxrss,
+    which is the peak RSS of fll or any child up to the end of the phase.
+    Phases which overlap in different threads are charged each other's
+    usage.
+
+    Estimates, such as of the time a build mode saved, are recorded apart
+    from the spans, as they were not measured.
+
+    Nothing is recorded unless the trace is enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """Forget all spans."""
+        self.lock = threading.Lock()
+        self.events = list()
+        self.estimates = list()
+        self.threads = dict()
+
+    def _tid(self):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = (len(self.threads) + 1,
+                                              thread.name)
+            return self.threads[thread.ident][0]
+
+    def add(self, name, cat, begin, end, args={}):
+        """Record a span which began and ended at the given times."""
+        if not self.enabled:
+            return
+        event = dict(name=name, cat=cat, ph='X', pid=os.getpid(),
+                     tid=self._tid(), ts=int(begin * 10**6),
+                     dur=int((end - begin) * 10**6))
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def estimate(self, name, seconds, args={}):
+        """Record an estimate of seconds, such as of the time saved by a
+        build mode."""
+        if not self.enabled:
+            return
+        event = dict(name=name, cat='estimate', ph='C', pid=os.getpid(),
+                     tid=self._tid(), ts=int(time.time() * 10**6),
+                     args=dict(args, seconds=seconds))
+        with self.lock:
+            self.estimates.append(event)
+
+    @contextmanager
+    def span(self, name, cat='phase', **args):
+        """Record the time spent in a with block as a span. The args of the
+        span are given to the with block, which may add to them. The usage
+        of a phase is added to its args."""
+        if not self.enabled:
+            yield args
+            return
+        begin = time.time()
+        if cat == 'phase':
+            before = _usage()
+        try:
+            yield args
+        finally:
+            if cat == 'phase':
+                after = _usage()
+                for k in after:
+                    args[k] = after[k] - before[k]
+                args['maxrss'] = after['maxrss']
+            self.add(name, cat, begin, time.time(), args)
+
+    def write(self, filename):
+        """Write the spans to filename in the Chrome trace event format."""
+        with self.lock:
+            events = self.events + self.estimates
+            threads = self.threads.values()
+        pid = os.getpid()
+        for tid, name in threads:
+            events.append(dict(name='thread_name', ph='M', pid=pid, tid=tid,
+                               args=dict(name=name)))
+        try:
+            with open(filename, 'w') as fh:
+                json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fh)
+        except IOError, e:
+            raise TraceError('failed to write trace: %s' % e)
+
+    def totals(self):
+        """Return a dict of the (count, wall, cpu, maxrss, inblock,
+        oublock) totals of the spans, by (category, name). wall and cpu are
+        seconds, maxrss the largest peak RSS in kB."""
+        totals = dict()
+        with self.lock:
+            for e in self.events:
+                key = (e['cat'], e['name'])
+                args = e.get('args', {})
+                count, wall, cpu, rss, inblock, oublock = \
+                    totals.get(key, (0, 0, 0, 0, 0, 0))
+                totals[key] = (count + 1, wall + e['dur'] / 1e6,
+                               cpu + args.get('utime', 0) +
+                               args.get('stime', 0),
+                               max(rss, args.get('maxrss', 0)),
+                               inblock + args.get('inblock', 0),
+                               oublock + args.get('oublock', 0))
+        return totals
+
+    def summary(self, limit=25):
+        """Return the lines of a table of phases and commands, by name,
+        sorted by the total time spent in them. CPU is the user and system
+        seconds and CPU% its share of the wall time, RSS the peak RSS in MB
+        and READ and WRITE the MB read and written to block devices. A
+        phase which is neither busy on CPU nor disk is waiting on the
+        network, or on a command which is. Estimates follow the table."""
+        totals = self.totals()
+        rows = sorted(totals.iteritems(), key=lambda r: r[1][1],
+                      reverse=True)
+        lines = ['%10s %6s %9s %5s %6s %8s %8s  %-6s %s' %
+                 ('WALL', 'COUNT', 'CPU', 'CPU%', 'RSS', 'READ', 'WRITE',
+                  'TYPE', 'NAME')]
+        for (cat, name), (count, wall, cpu, rss, inblock, oublock) in \
+                rows[:limit]:
+            lines.append('%10.2f %6d %9.2f %5d %6d %8d %8d  %-6s %s' %
+                         (wall, count, cpu, wall and 100 * cpu / wall or 0,
+                          rss / 2**10, inblock / 2**20, oublock / 2**20,
+                          cat, name))
+        with self.lock:
+            estimates = list(self.estimates)
+        for e in estimates:
+            args = e['args'].copy()
+            seconds = args.pop('seconds')
+            lines.append('%10.2f %6s %9s %5s %6s %8s %8s  %-6s %s (%s)' %
+                         (seconds, '', '', '', '', '', '', 'est.', e['name'],
+                          ', '.join(['%s=%s' % (k, args[k])
+                                     for k in sorted(args)])))
+        return lines
+
+
+# the trace of the build of this process
+_trace = Trace()
+
+def enable(enabled=True):
+    """Enable or disable the recording of spans."""
+    _trace.enabled = enabled
+
+def enabled():
+    return _trace.enabled
+
+def reset():
+    _trace.reset()
+
+def add(name, cat, begin, end, args={}):
+    _trace.add(name, cat, begin, end, args)
+
+def span(name, cat='phase', **args):
+    return _trace.span(name, cat, **args)
+
+def estimate(name, seconds, **args):
+    _trace.estimate(name, seconds, args)
+
+def traced(name, cat='phase'):
+    """Decorate a function so that each call of it is recorded as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _trace.span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def write(filename):
+    _trace.write(filename)
+
+def totals():
+    return _trace.totals()
+
+def summary(limit=25):
+    return _trace.summary(limit)
@@ -197,7 +197,8 @@ setup(
     scripts=['bin/fll'],
     data_files=[
         ('/usr/share/fll/data', ['data/locales-pkg-map',
-                                 'data/fll.conf.spec']),
+                                 'data/fll.conf.spec',
+                                 'data/fll-nosync.c']),
     ],
     cmdclass={
         'build_manpages': build_manpages,